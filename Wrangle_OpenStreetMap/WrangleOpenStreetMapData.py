@@ -16,20 +16,317 @@
 
 # In[2]:
 
-# First to use iterative parsing to process the map file and find out what the tags are.
+# The map file is large, and parsing it is the slow part of every audit. So instead of parsing the file once per audit,
+# each audit below registers a visitor, and all of them run together in one iterative parsing pass.
+# A visitor takes an element and its running result, and returns the updated result.
 import xml.etree.ElementTree as ET
+import xml.parsers.expat
 import pprint
+import copy
+import gc
+from collections import OrderedDict
+try:
+    import lxml.etree
+except ImportError:
+    lxml = None
 
 filename = 'san-jose_california.osm'
 
-tags = {}
-for event, elem in ET.iterparse(filename):
-    if elem.tag in tags:
-        tags[elem.tag] += 1
+audit_visitors = []
+audit_cache = {}
+
+def register_audit(name, visitor, initial):
+    audit_visitors.append((name, visitor, initial))
+    # results collected without this audit are no longer complete
+    audit_cache.clear()
+
+# Every parser below reads a map file (a file name or a binary file object) into the same plain records,
+# one for the root and one for each top-level element (node, way, relation, bounds):
+#
+# (tag, attrib, [(k, v) of its tags], [ref of its nds], [(type, ref, role) of its members])
+#
+# The conversion only needs these, and the audits get elements built back from them.
+
+def element_record(element):
+    return (element.tag, element.attrib,
+            [(tag.attrib['k'], tag.attrib['v']) for tag in element.iter('tag')],
+            [nd.attrib['ref'] for nd in element.iter('nd')],
+            [(m.attrib['type'], m.attrib['ref'], m.attrib.get('role', '')) for m in element.iter('member')])
+
+def record_element(record):
+    tag, attrib, tags, refs, members = record
+    element = ET.Element(tag, attrib)
+    # same child order as the osm xml: node refs and members first, then the tags
+    for ref in refs:
+        ET.SubElement(element, 'nd', {'ref': ref})
+    for member_type, ref, role in members:
+        ET.SubElement(element, 'member', {'type': member_type, 'ref': ref, 'role': role})
+    for k, v in tags:
+        ET.SubElement(element, 'tag', {'k': k, 'v': v})
+    return element
+
+# iterparse keeps every parsed element attached to the root, so the tree grows with the file.
+# This takes each top-level element when it ends, and clears the root once it has been handed out,
+# so memory stays flat no matter how big the file is.
+def etree_records(source):
+    context = ET.iterparse(source, events=("start", "end"))
+    event, root = next(context)
+    yield (root.tag, dict(root.attrib), [], [], [])
+    depth = 0
+    for event, elem in context:
+        if event == "start":
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 0:
+                yield element_record(elem)
+                root.clear()
+
+# expat calls back for every start tag, and the records are built right there, without any element objects.
+# An element's children all come before the next top-level element starts, so no end tag callbacks are needed:
+# the last record is only handed out once the next one has started, or the file has ended.
+def expat_records(source, block_size = 1 << 20):
+    parser = xml.parsers.expat.ParserCreate()
+    records = []
+
+    def start(name, attrib):
+        if name == 'tag':
+            records[-1][2].append((attrib['k'], attrib['v']))
+        elif name == 'nd':
+            records[-1][3].append(attrib['ref'])
+        elif name == 'member':
+            records[-1][4].append((attrib['type'], attrib['ref'], attrib.get('role', '')))
+        else:
+            records.append((name, attrib, [], [], []))
+
+    parser.StartElementHandler = start
+    f = open(source, 'rb') if isinstance(source, str) else source
+    try:
+        while True:
+            block = f.read(block_size)
+            # the records hold no reference cycles, so there is no point in the garbage collector
+            # scanning them over and over while a block is parsed
+            gc_enabled = gc.isenabled()
+            gc.disable()
+            try:
+                parser.Parse(block, not block)
+            finally:
+                if gc_enabled:
+                    gc.enable()
+            if not block:
+                break
+            ready = records[:-1]
+            del records[:-1]
+            for record in ready:
+                yield record
+    finally:
+        if f is not source:
+            f.close()
+    for record in records:
+        yield record
+
+# lxml only reports the top-level elements asked for, but hands each one to Python as a proxy object,
+# which makes it slower than the other two on osm files. It is here for setups that already use it.
+def lxml_records(source):
+    context = lxml.etree.iterparse(source, events=("end",), tag=('node', 'way', 'relation', 'bounds'))
+    root = None
+    for event, elem in context:
+        if root is None:
+            root = elem.getparent()
+            yield (root.tag, dict(root.attrib), [], [], [])
+        yield (elem.tag, dict(elem.attrib),
+               [(tag.get('k'), tag.get('v')) for tag in elem.iterchildren('tag')],
+               [nd.get('ref') for nd in elem.iterchildren('nd')],
+               [(m.get('type'), m.get('ref'), m.get('role', '')) for m in elem.iterchildren('member')])
+        # drop the element, and the ones before it that the root still holds
+        elem.clear()
+        while elem.getprevious() is not None:
+            del root[0]
+
+# the parsers, fastest first; the first one available is used unless xml_backend names another
+xml_backends = OrderedDict([('expat', expat_records), ('etree', etree_records), ('lxml', lxml_records)])
+xml_backend = None
+
+def pick_backend(backend = None):
+    backend = backend or xml_backend
+    if backend is None:
+        backend = next(name for name in xml_backends if name != 'lxml' or lxml is not None)
+    if backend == 'lxml' and lxml is None:
+        raise ValueError("the lxml backend needs lxml installed")
+    return xml_backends[backend]
+
+# the records of a map file.
+# .osm.pbf extracts are decoded by the PBF reader in the "Reading PBF extracts" section below.
+# With a region, only the elements in it are kept (see "Regional extracts" below).
+def iter_records(source, backend = None, region = None):
+    name = source if isinstance(source, str) else getattr(source, 'name', '')
+    if isinstance(name, str) and name.endswith('.pbf'):
+        records = iter_pbf_records(source)
+    elif isinstance(name, str) and (name.endswith('.osc') or name.endswith('.osc.gz')):
+        # the created and modified elements of a change file (see "Keeping the collection up to date" below)
+        records = changed_records(source)
     else:
-        tags[elem.tag] = 1
-        
-pprint.pprint(tags)
+        records = pick_backend(backend)(source)
+    if region is not None:
+        records = region_records(records, region)
+    return records
+
+# each element of a map file, its children first
+def iter_map(filename, backend = None, region = None):
+    for record in iter_records(filename, backend, region):
+        element = record_element(record)
+        for child in element:
+            yield child
+        yield element
+
+# The audits and the reports below are run again every time the notebook is, though the map file and the collection
+# seldom change in between. So their results are also kept in a cache on disk, a directory with a pickle file for
+# each result, named after a hash of everything the result depends on:
+#
+# * for the audits, the size and modification time of the map file (or, with 'hash' set, a hash of its contents),
+#   the region, and the audits registered, or the regex and the expected list of a street audit,
+# * for an aggregation, the pipeline, and a version of the collection that load_map and apply_changes bump.
+#
+# A change to any of these makes a new key, so an old result is never handed out, it is just not used any more.
+# Each hit touches its file, and once the files take more than max_bytes, the least recently used ones are removed.
+# clear_cache removes them all, or those of one kind.
+
+import os
+import hashlib
+import pickle
+
+result_cache = {'enabled': True, 'path': 'wrangle_cache', 'max_bytes': 1 << 28, 'hash': False}
+result_cache_stats = {"hits": 0, "misses": 0}
+cache_miss = object()
+file_hashes = {}
+
+def file_stamp(filename):
+    # what tells one version of a map file from another, or None for a file object, which is not cached
+    if not isinstance(filename, str):
+        return None
+    st = os.stat(filename)
+    stamp = (os.path.abspath(filename), st.st_size, st.st_mtime_ns)
+    if not result_cache['hash']:
+        return stamp
+    if stamp not in file_hashes:
+        digest = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        file_hashes[stamp] = digest.hexdigest()
+    return file_hashes[stamp]
+
+def cache_key(kind, *parts):
+    # the parts are numbers, strings, and tuples or lists of them, whose repr is the same from run to run
+    return "{0}-{1}".format(kind, hashlib.sha1(repr(parts).encode('utf-8')).hexdigest())
+
+def cache_file(key):
+    return os.path.join(result_cache['path'], key + '.pickle')
+
+def cache_get(key):
+    if not result_cache['enabled']:
+        return cache_miss
+    name = cache_file(key)
+    try:
+        with open(name, 'rb') as f:
+            value = pickle.load(f)
+    except (IOError, OSError):
+        result_cache_stats["misses"] += 1
+        return cache_miss
+    except Exception:
+        # written by another version of the code, or cut short
+        os.remove(name)
+        result_cache_stats["misses"] += 1
+        return cache_miss
+    os.utime(name)
+    result_cache_stats["hits"] += 1
+    return value
+
+def cache_put(key, value):
+    if not result_cache['enabled']:
+        return value
+    if not os.path.isdir(result_cache['path']):
+        os.makedirs(result_cache['path'])
+    name = cache_file(key)
+    # written under another name and then renamed, so a reader never sees half of it
+    with open(name + '.tmp', 'wb') as f:
+        pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(name + '.tmp', name)
+    evict_cache()
+    return value
+
+def cache_entries():
+    # (last used, bytes, path) of each file in the cache
+    entries = []
+    for name in os.listdir(result_cache['path']):
+        if name.endswith('.pickle'):
+            path = os.path.join(result_cache['path'], name)
+            st = os.stat(path)
+            entries.append((st.st_mtime, st.st_size, path))
+    return entries
+
+def evict_cache():
+    entries = sorted(cache_entries())
+    total = sum(size for used, size, path in entries)
+    for used, size, path in entries:
+        if total <= result_cache['max_bytes']:
+            break
+        os.remove(path)
+        total -= size
+
+def clear_cache(kind = None):
+    # remove every cached result, or the results of one kind ('audits', 'audit' or 'aggregate')
+    audit_cache.clear()
+    if not os.path.isdir(result_cache['path']):
+        return 0
+    removed = 0
+    for used, size, path in cache_entries():
+        if kind is None or os.path.basename(path).startswith(kind + '-'):
+            os.remove(path)
+            removed += 1
+    return removed
+
+def audit_signature():
+    # what the audit results depend on besides the file: the audits registered, their code and their settings
+    signature = []
+    for name, visitor, initial in audit_visitors:
+        closure = [cell.cell_contents for cell in visitor.__closure__ or ()]
+        signature.append((name, visitor.__code__.co_code, repr(closure), repr(initial)))
+    return signature
+
+def run_audits(filename, region = None):
+    # keyed by the file's stamp, so a file written again since is audited again
+    stamp = file_stamp(filename)
+    region = None if region is None else make_region(region)
+    key = (filename if stamp is None else stamp, region)
+    if key in audit_cache:
+        return audit_cache[key]
+    if stamp is not None:
+        disk_key = cache_key('audits', stamp, region, audit_signature())
+        results = cache_get(disk_key)
+        if results is not cache_miss:
+            audit_cache[key] = results
+            return results
+    results = {}
+    for name, visitor, initial in audit_visitors:
+        results[name] = copy.deepcopy(initial)
+    for elem in iter_map(filename, region=region):
+        for name, visitor, initial in audit_visitors:
+            results[name] = visitor(elem, results[name])
+    audit_cache[key] = results
+    if stamp is not None:
+        cache_put(disk_key, results)
+    return results
+
+# First to find out what the tags are.
+def count_tags(element, tags):
+    if element.tag in tags:
+        tags[element.tag] += 1
+    else:
+        tags[element.tag] = 1
+    return tags
+
+register_audit('tags', count_tags, {})
 
 
 # In[3]:
@@ -60,29 +357,39 @@ def key_type(element, keys):
         
     return keys
 
-def process_map(filename):
-    keys = {"lower": 0, "lower_colon": 0, "problemchars": 0, "other": 0}
-    for _, element in ET.iterparse(filename):
-        keys = key_type(element, keys)
-
-    return keys
-
-process_map(filename)
+register_audit('keys', key_type, {"lower": 0, "lower_colon": 0, "problemchars": 0, "other": 0})
 
 
 # In[4]:
 
 # Third, I want to see how many unique users have contributed to this map data.
-def process_map(filename):
-    users = set()
-    for _, element in ET.iterparse(filename):
-        if "uid" in element.attrib:
-            users.add(element.attrib["uid"])
-
+def collect_users(element, users):
+    if "uid" in element.attrib:
+        users.add(element.attrib["uid"])
     return users
 
-users = process_map(filename)
-len(users)
+register_audit('users', collect_users, set())
+
+# The street names and postal codes are audited further below. Collect their distinct values in the same pass,
+# so the street audits can be rerun with any regex and expected list without parsing the file again.
+def tag_value_collector(key):
+    def collect_values(element, values):
+        if element.tag == "node" or element.tag == "way":
+            for tag in element.iter("tag"):
+                if tag.attrib['k'] == key:
+                    values.add(tag.attrib['v'])
+        return values
+    return collect_values
+
+register_audit('street_names', tag_value_collector("addr:street"), set())
+register_audit('postcodes', tag_value_collector("addr:postcode"), set())
+
+# now, run all the audits in one pass
+audit_results = run_audits(filename)
+
+pprint.pprint(audit_results['tags'])
+pprint.pprint(audit_results['keys'])
+len(audit_results['users'])
 
 
 # ## Problems with the data
@@ -109,16 +416,21 @@ def is_street_name(elem):
     return (elem.attrib['k'] == "addr:street")
 
 # audit the street type, and return the unexpected ones
-def audit(filename, reg_string, expected_list):
-    osm_file = open(filename, "r")
+# the street names come from the shared audit pass, so this does not parse the file again,
+# and the result is cached on disk too, for the same file, region, regex and expected list
+def audit(filename, reg_string, expected_list, region = None):
+    stamp = file_stamp(filename)
+    if stamp is not None:
+        key = cache_key('audit', stamp, region and make_region(region), reg_string.pattern, reg_string.flags,
+                        sorted(set(expected_list)))
+        return_list = cache_get(key)
+        if return_list is not cache_miss:
+            return return_list
     return_list = defaultdict(set)
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
-
-        if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):
-                if is_street_name(tag):
-                    audit_street_type(return_list, tag.attrib['v'], reg_string, expected_list)
-    osm_file.close()
+    for street_name in run_audits(filename, region)['street_names']:
+        audit_street_type(return_list, street_name, reg_string, expected_list)
+    if stamp is not None:
+        cache_put(key, return_list)
     return return_list 
 
 #run the audit for street types
@@ -162,9 +474,15 @@ expected_names = ["Street", "Avenue", "Boulevard", "Drive", "Court", "Place", "S
             ] 
                  
 
-# also create a not_import_list for later
-not_to_import_list = ["Brunnenweg",u"B\xe4derstra\xdfe", "Cergowska", u"Jana Paw\u0142a II", u"Klosterstra\xdfe", 
-                      "Marii Konopnickiej", u"S\u0142owacka"]
+# also create a not_import_list for later.
+# It is kept in cleaning_rules.json, together with the other street fixes the conversion applies.
+import json
+
+rules_file = 'cleaning_rules.json'
+with open(rules_file) as f:
+    cleaning_rules = json.load(f)
+
+not_to_import_list = cleaning_rules['drop']
 
 # now, rerun the audit
 street_types = audit(filename,street_type_re,expected_names)
@@ -209,18 +527,19 @@ def update_name(name_to_update, mapping, re_string, expected_strings):
     m = re_string.search(name_to_update)
     if m:
         street_return = m.group()
-        if street_return not in expected_strings:
+        # leave the names we have no mapping for as they are
+        if street_return not in expected_strings and street_return in mapping:
             name_to_update = re.sub(re_string, mapping[street_return], name_to_update)
 
     return name_to_update
 
 #test out to see if the update street name works
-for st_type, ways in street_types.iteritems():
+for st_type, ways in street_types.items():
     if st_type in mapping_street_type:
         for name in ways:
             #update the street name abbreviations
             new_name = update_name(name, mapping_street_type, street_type_re, expected_names)
-            print name, "=>", new_name
+            print(name, "=>", new_name)
                      
 
 
@@ -259,12 +578,123 @@ mapping_street_direction ={
 
 # Now, let's run the update function and update the street direction abbreviations.
 
-for st_type, ways in street_directions.iteritems():
+for st_type, ways in street_directions.items():
     if st_type in mapping_street_direction:
         for name in ways:
             #update the street direction abbreviations
             new_name = update_name(name, mapping_street_direction, street_direction_re, expected_directions)
-            print name, "=>", new_name
+            print(name, "=>", new_name)
+
+
+# When converting the data, every street name goes through both updates, and the same street names repeat
+# thousands of times across nodes and ways. So combine the two updates into one transformation,
+# and remember the names already normalized.
+
+# In[10]:
+
+from collections import OrderedDict
+
+def compile_fixes(mapping, expected_strings):
+    # the expected strings are never replaced, so they can be left out of the mapping up front
+    return dict((k, v) for k, v in mapping.items() if k not in expected_strings)
+
+street_fixes = []
+street_cache = OrderedDict()
+street_cache_stats = {"hits": 0, "misses": 0}
+street_cache_size = 100000
+
+def compile_street_fixes():
+    # rerun this after changing the mappings or the expected lists
+    street_fixes[:] = [(street_type_re, compile_fixes(mapping_street_type, expected_names)),
+                       (street_direction_re, compile_fixes(mapping_street_direction, expected_directions))]
+    street_cache.clear()
+
+compile_street_fixes()
+
+def normalize_street(name):
+    if name in street_cache:
+        street_cache_stats["hits"] += 1
+        # move it to the end, so the least recently used names are dropped first
+        new_name = street_cache.pop(name)
+        street_cache[name] = new_name
+        return new_name
+    street_cache_stats["misses"] += 1
+    new_name = name
+    for re_string, fixes in street_fixes:
+        m = re_string.search(new_name)
+        if m and m.group() in fixes:
+            new_name = new_name[:m.start()] + fixes[m.group()] + new_name[m.end():]
+    street_cache[name] = new_name
+    if len(street_cache) > street_cache_size:
+        street_cache.popitem(last=False)
+    return new_name
+
+def normalize_streets(names):
+    # normalize a list (or array) of names, each distinct name only once
+    normalized = dict((name, normalize_street(name)) for name in set(names))
+    return [normalized[name] for name in names]
+
+pprint.pprint(normalize_streets(["N 1st St", "Stevens Creek Blvd", "N 1st St"]))
+
+
+# A few street names need more than spelling out abbreviations (see 4-7 above), and the list of such fixes keeps growing.
+# So they are data in cleaning_rules.json, not code:
+# 
+# 1. "drop": street names not to import,
+# 2. "overrides": exact street names, and the address fields to use for them,
+# 3. "split": regular expressions whose named groups (street, unit, city, state, housenumber) become address fields.
+# 
+# A house number is only split off when a direction follows it, as in '1425 E Dunne Ave', so that numbered
+# street names such as '10 Mile Road' stay whole.
+# 
+# The exact matches are dictionary lookups, and the split rules are combined into one regular expression,
+# so cleaning a street name costs about the same however many rules there are.
+
+# In[11]:
+
+from collections import Counter
+
+street_rules = {}
+rule_hits = Counter()
+
+def compile_rules(rules):
+    patterns = []
+    split_fields = []
+    for i, rule in enumerate(rules['split']):
+        # the group names must be unique in the combined expression, so prefix them with the rule number
+        pattern = re.sub(r'\(\?P<(\w+)>', r'(?P<r{0}_\1>'.format(i), rule['pattern'])
+        patterns.append('(?P<rule{0}>{1})'.format(i, pattern))
+        split_fields.append((rule['name'], re.findall(r'\(\?P<(\w+)>', rule['pattern'])))
+    street_rules['drop'] = set(rules['drop'])
+    street_rules['overrides'] = rules['overrides']
+    street_rules['split'] = re.compile('|'.join(patterns)) if patterns else None
+    street_rules['split_fields'] = split_fields
+
+compile_rules(cleaning_rules)
+
+def clean_street(name):
+    # the address fields for a street name, or None if it should not be imported
+    if name in street_rules['drop']:
+        rule_hits['drop: ' + name] += 1
+        return None
+    if name in street_rules['overrides']:
+        rule_hits['override: ' + name] += 1
+        return dict(street_rules['overrides'][name])
+    m = street_rules['split'].match(name) if street_rules['split'] else None
+    if m:
+        i = int(m.lastgroup[len('rule'):])
+        rule_name, fields = street_rules['split_fields'][i]
+        rule_hits['split: ' + rule_name] += 1
+        address = {}
+        for field in fields:
+            address[field] = m.group('r{0}_{1}'.format(i, field))
+        if 'street' in address:
+            address['street'] = normalize_street(address['street'])
+        return address
+    return {'street': normalize_street(name)}
+
+def report_rule_hits():
+    pprint.pprint(rule_hits.most_common())
 
 
 # Now, I also want to look at the postal code.
@@ -274,19 +704,11 @@ for st_type, ways in street_directions.iteritems():
 def is_postal_code(elem):
     return (elem.attrib['k'] == "addr:postcode")
 
-        
-osm_file = open(filename, "r")
-return_zip_list = set()
-for event, elem in ET.iterparse(osm_file, events=("start",)):
 
-        if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):
-                if is_postal_code(tag):
-                    return_zip_list.add(tag.attrib['v'])
-               
-osm_file.close()
+# the postal codes were collected in the shared audit pass
+return_zip_list = run_audits(filename)['postcodes']
 
-pprint.pprint(return_list)
+pprint.pprint(return_zip_list)
 
 
 # Now, let's write a function to update the zip code.
@@ -301,7 +723,7 @@ def update_zip_code(zip_in):
 
 for zip_code in return_zip_list:
     updated_zip = update_zip_code(zip_code)
-    print updated_zip
+    print(updated_zip)
 
 
 # ## Prepare for MongoDB
@@ -338,7 +760,7 @@ The output should be a list of dictionaries that look like this:
 """
 
 # -*- coding: utf-8 -*-
-import xml.etree.cElementTree as ET
+import xml.etree.ElementTree as ET
 import pprint
 import re
 import codecs
@@ -350,86 +772,73 @@ problemchars = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
 
 CREATED = [ "version", "changeset", "timestamp", "user", "uid"]
 
-def shape_element(element):
+# With relations, the relations are shaped too, with their members (see "Relations" below)
+def shape_record(record, relations = False):
+    tag, attrib, tags, refs, members = record
     node = {}
     # create an address dictionary
     address = {}
-    if element.tag == "node" or element.tag == "way" :
+    if tag == "node" or tag == "way" or (relations and tag == "relation"):
         
-        node['type'] = element.tag
+        node['type'] = tag
         # parse attributes
-        for a in element.attrib:
+        for a in attrib:
             if a in CREATED:
                 if 'created' not in node:
                     node['created'] = {}
-                node['created'][a] = element.attrib[a]
+                node['created'][a] = attrib[a]
             elif a in ['lat', 'lon']:
                 if 'pos' not in node:
                     node['pos'] = [None, None]
                 if a == 'lat':
-                    node['pos'][0] = float(element.attrib[a])
+                    node['pos'][0] = float(attrib[a])
                 else:
-                    node['pos'][1] = float(element.attrib[a])
+                    node['pos'][1] = float(attrib[a])
             else:
-                node[a] = element.attrib[a]
-        # iterate tag children
-        for tag in element.iter('tag'):
-            if not problemchars.search(tag.attrib['k']):
+                node[a] = attrib[a]
+        # iterate the tags
+        for k, v in tags:
+            if not problemchars.search(k):
                 #tags with single colon
-                if lower_colon.search(tag.attrib['k']):
+                if lower_colon.search(k):
                     #single colon beginning with addr
-                    if tag.attrib['k'].find('addr') == 0:
+                    if k.find('addr') == 0:
                         if 'address' not in node:
                             node['address'] = {}
-                        sub_attr = tag.attrib['k'].split(':', 1)
+                        sub_attr = k.split(':', 1)
                         #if it is a street name tag
-                        if is_street_name(tag):
-                            # not to import the street names I believe that are mistakenly entered for the area
-                            if tag.attrib['v'] not in not_to_import_list:
-                                # there are a few cases I want to handle manually before importing to MongoDB
-                                if tag.attrib['v'] == 'Stewart Drive Suite #1':
-                                     address['street'] = 'Stewart Drive'
-                                     address['unit'] = 'Suite #1'
-                                elif tag.attrib['v'] == 'West Evelyn Avenue Suite #114':
-                                     address['street'] = 'West Evelyn Avenue'
-                                     address['unit'] = 'Suite #114'
-                                elif tag.attrib['v'] == 'Zanker Rd., San Jose, CA' or tag.attrib['v'] == 'Zanker Road, San Jose, CA':
-                                     address['street'] = 'Zanker Road'
-                                     address['city'] = 'San Jose'
-                                     address['state'] = 'CA'
-                                elif tag.attrib['v'] == '1425 E Dunne Ave':
-                                     address['street'] = 'East Dunne Avenue'
-                                     address['housenumber'] = '1425'
-                                else:    
-                                    #update the street name abbreviations
-                                    new_name_1 = update_name(tag.attrib['v'], mapping_street_type, street_type_re, expected_names)
-                                    #update the street direction abbreviations
-                                    new_name_2 = update_name(new_name_1, mapping_street_direction, street_direction_re, expected_directions)
-                                    address[sub_attr[1]] = new_name_2
+                        if k == "addr:street":
+                            # drop, override, split or update the street name, as the cleaning rules say
+                            street_fields = clean_street(v)
+                            if street_fields is not None:
+                                address.update(street_fields)
                         # if it is a postal code tag            
-                        elif is_postal_code(tag):
+                        elif k == "addr:postcode":
                             #update the postal code
-                            new_zip = update_zip_code(tag.attrib['v'])
+                            new_zip = update_zip_code(v)
                             address[sub_attr[1]] = new_zip
                         
                         # not a street name tag, or a postcode tag
                         else:
-                             address[sub_attr[1]] = tag.attrib['v']
+                             address[sub_attr[1]] = v
                     #all other single colons processed normally
                     else:
-                        node[tag.attrib['k']] = tag.attrib['v']
+                        node[k] = v
+                # a relation's type tag would replace its type
+                elif tag == "relation" and k == "type":
+                    node['relation_type'] = v
                 #tags with no colon
-                elif tag.attrib['k'].find(':') == -1:
-                    node[tag.attrib['k']] = tag.attrib['v']
+                elif k.find(':') == -1:
+                    node[k] = v
                     
                 #assign the address dictionary to the node    
                 if address:
                     node['address'] = address
-        # iterate nd children
-        for nd in element.iter('nd'):
-            if 'node_refs' not in node:
-                node['node_refs'] = []
-            node['node_refs'].append(nd.attrib['ref'])
+        # the node refs
+        if refs:
+            node['node_refs'] = list(refs)
+        if members:
+            node['members'] = [{'type': member_type, 'ref': ref, 'role': role} for member_type, ref, role in members]
             
                    
         
@@ -437,21 +846,1769 @@ def shape_element(element):
     else:
         return None
 
-def process_map(file_in, pretty = False):
-    # You do not need to change this file
+# the same for a parsed element
+def shape_element(element):
+    if element.tag == "node" or element.tag == "way":
+        return shape_record(element_record(element))
+    return None
+
+def to_json_line(el, pretty = False):
+    if pretty:
+        return json.dumps(el, indent=2)+"\n"
+    return json.dumps(el) + "\n"
+
+# the shaped documents of a map file, one at a time.
+# With geometry, the ways also get the coordinates of their nodes (see "Way geometry" below),
+# and with relations too, the multipolygons and boundaries get their rings.
+def shape_map(file_in, geometry = False, region = None, relations = False):
+    # with the metrics on (see below), each stage is timed, and the records counted as they are read
+    if metrics['enabled']:
+        records = timed_stage('parse', instrumented_records(file_in, region=region))
+    else:
+        records = iter_records(file_in, region=region)
+    docs = (shape_record(record, relations) for record in records)
+    docs = (el for el in docs if el)
+    if metrics['enabled']:
+        docs = timed_stage('shape', docs)
+    if geometry:
+        nodes = node_store()
+        docs = with_way_geometry(docs, nodes)
+        if relations:
+            docs = with_relation_rings(docs, nodes)
+        if metrics['enabled']:
+            docs = timed_stage('geometry', docs)
+    return docs
+
+# write the json file as the elements are shaped, and yield the shaped documents one at a time.
+# Nothing is kept: the parsed elements are released as we go, so memory stays flat for state-sized files.
+def stream_map(file_in, pretty = False, geometry = False, region = None, relations = False):
     file_out = "{0}.json".format(file_in)
-    data = []
+    rule_hits.clear()
     with codecs.open(file_out, "w") as fo:
-        for _, element in ET.iterparse(file_in):
-            el = shape_element(element)
-            if el:
-                data.append(el)
-                if pretty:
-                    fo.write(json.dumps(el, indent=2)+"\n")
-                else:
-                    fo.write(json.dumps(el) + "\n")
-    return data
+        serialize, write = to_json_line, fo.write
+        if metrics['enabled']:
+            serialize, write = timed_call('json', serialize), timed_call('write', write)
+        for el in shape_map(file_in, geometry, region, relations):
+            write(serialize(el, pretty))
+            yield el
+    report_rule_hits()
+
+# With pipeline, or a compression, the stages run side by side (see pipeline_map below).
+def process_map(file_in, pretty = False, geometry = False, pipeline = False, compression = None, region = None,
+                relations = False):
+    # You do not need to change this file
+    if pipeline or compression:
+        return list(pipeline_map(file_in, pretty, geometry, compression, region=region, relations=relations))
+    return list(stream_map(file_in, pretty, geometry, region, relations))
+
+
+# A conversion of a big extract runs for many minutes without a word. With start_metrics, shape_map and stream_map
+# keep count of what they do and how long each stage takes:
+# 
+# * the time spent parsing, shaping, adding geometry, serializing to json and writing,
+# * the number of each kind of element, of tags, and of tags dropped for problem characters, and the rule hits,
+# * how much of the file has been read, and when the rest should be done,
+# * the largest resident memory seen.
+# 
+# Every interval seconds this goes to a progress callback and to a sink, a json lines file or, for a path ending in
+# .prom, a Prometheus text file, and stop_metrics writes the totals. With profile set, the functions the conversion
+# is in are also sampled every profile seconds of CPU time. While the metrics are off, the conversion runs as before.
+
+# In[35]:
+
+import os
+import sys
+import time
+import signal
+try:
+    import resource
+except ImportError:
+    resource = None
+
+metrics = {'enabled': False}
+
+# the stages, and the stage each one's timer includes (the documents are pulled through the stages before it)
+metrics_stages = [('parse', None), ('shape', 'parse'), ('geometry', 'shape'), ('json', None), ('write', None)]
+
+def start_metrics(sink = None, progress = None, interval = 1.0, profile = None):
+    now = time.time()
+    metrics.clear()
+    metrics.update({'enabled': True, 'sink': sink, 'progress': progress, 'interval': interval, 'start': now,
+                    'last': now, 'timers': Counter(), 'counts': Counter(), 'bytes read': 0, 'bytes total': 0,
+                    'peak rss': current_rss(), 'samples': None, 'sampler': None})
+    if profile:
+        if not hasattr(signal, 'setitimer'):
+            raise ValueError("profiling needs signal.setitimer, which this system does not have")
+        samples = metrics['samples'] = {'count': 0, 'self': Counter(), 'total': Counter()}
+        metrics['sampler'] = signal.signal(signal.SIGPROF, lambda signum, frame: sample_stack(samples, frame))
+        signal.setitimer(signal.ITIMER_PROF, profile, profile)
+
+def stop_metrics():
+    if not metrics['enabled']:
+        return None
+    if metrics['samples'] is not None:
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, metrics['sampler'])
+    metrics['peak rss'] = max(metrics['peak rss'], current_rss())
+    report = metrics_report()
+    if metrics['samples']:
+        report['profile'] = {'samples': metrics['samples']['count'],
+                             'self': metrics['samples']['self'].most_common(20),
+                             'total': metrics['samples']['total'].most_common(20)}
+    write_metrics('summary', report)
+    metrics['enabled'] = False
+    return report
+
+def current_rss():
+    # the resident memory of the process now, or the largest so far where that is all the system tells
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        if resource is None:
+            return 0
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        return rss if sys.platform == 'darwin' else rss * 1024
+
+def timed_stage(name, iterable):
+    # add the time spent getting each item to the stage's timer
+    timers = metrics['timers']
+    clock = time.perf_counter
+    iterator = iter(iterable)
+    while True:
+        start = clock()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            timers[name] += clock() - start
+            return
+        timers[name] += clock() - start
+        yield item
+
+def timed_call(name, function):
+    timers = metrics['timers']
+    clock = time.perf_counter
+    def timed(*args):
+        start = clock()
+        result = function(*args)
+        timers[name] += clock() - start
+        return result
+    return timed
+
+def instrumented_records(file_in, every = 1000, region = None):
+    # the records of the file, counted, and checking on the progress every so many records
+    counts = metrics['counts']
+    f = open(file_in, 'rb') if isinstance(file_in, str) else file_in
+    try:
+        start = f.tell()
+        read_before = metrics['bytes read']
+        metrics['bytes total'] += os.fstat(f.fileno()).st_size - start
+        for n, record in enumerate(iter_records(f, region=region), 1):
+            counts[record[0]] += 1
+            counts['tags'] += len(record[2])
+            for k, v in record[2]:
+                if problemchars.search(k):
+                    counts['problem tags'] += 1
+            if not n % every:
+                metrics['bytes read'] = read_before + f.tell() - start
+                metrics_tick()
+            yield record
+        metrics['bytes read'] = read_before + f.tell() - start
+    finally:
+        if f is not file_in:
+            f.close()
+    metrics_tick()
+
+def metrics_tick():
+    now = time.time()
+    if now - metrics['last'] < metrics['interval']:
+        return
+    metrics['last'] = now
+    metrics['peak rss'] = max(metrics['peak rss'], current_rss())
+    report = metrics_report()
+    if metrics['progress']:
+        metrics['progress'](report)
+    write_metrics('progress', report)
+
+def metrics_report():
+    elapsed = time.time() - metrics['start']
+    timers = metrics['timers']
+    stages = OrderedDict()
+    for name, base in metrics_stages:
+        if name in timers:
+            stages[name] = timers[name] - (timers[base] if base and not metrics.get('threaded stages') else 0)
+    read, total = metrics['bytes read'], metrics['bytes total']
+    report = {'elapsed': elapsed, 'stages': stages, 'counts': dict(metrics['counts']), 'rule hits': dict(rule_hits),
+              'bytes read': read, 'bytes total': total, 'fraction': float(read) / total if total else 0.0,
+              'peak rss': metrics['peak rss']}
+    # the rest of the file at the same speed
+    report['eta'] = elapsed * (total - read) / read if read else None
+    return report
+
+def write_metrics(event, report):
+    sink = metrics['sink']
+    if sink is None:
+        return
+    if sink.endswith('.prom'):
+        # the whole file is replaced each time, so a collector never reads half of it
+        with open(sink + '.tmp', 'w') as f:
+            f.write(prometheus_text(report))
+        os.replace(sink + '.tmp', sink)
+    else:
+        line = dict(report, event=event, time=time.time())
+        with open(sink, 'a') as f:
+            f.write(json.dumps(line) + "\n")
+
+def prometheus_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def prometheus_text(report):
+    lines = ['# TYPE osm_stage_seconds_total counter']
+    for name, seconds in report['stages'].items():
+        lines.append('osm_stage_seconds_total{{stage="{0}"}} {1}'.format(name, seconds))
+    lines.append('# TYPE osm_elements_total counter')
+    for name, count in sorted(report['counts'].items()):
+        lines.append('osm_elements_total{{kind="{0}"}} {1}'.format(prometheus_label(name), count))
+    lines.append('# TYPE osm_rule_hits_total counter')
+    for name, count in sorted(report['rule hits'].items()):
+        lines.append('osm_rule_hits_total{{rule="{0}"}} {1}'.format(prometheus_label(name), count))
+    for name, kind in [('elapsed', 'seconds'), ('bytes read', 'bytes'), ('bytes total', 'bytes'),
+                       ('fraction', 'ratio'), ('peak rss', 'bytes'), ('eta', 'seconds')]:
+        if report[name] is not None:
+            metric = 'osm_{0}_{1}'.format(name.replace(' ', '_'), kind)
+            lines.append('# TYPE {0} gauge'.format(metric))
+            lines.append('{0} {1}'.format(metric, report[name]))
+    return '\n'.join(lines) + '\n'
+
+def sample_stack(samples, frame):
+    # count the function the profiling signal interrupted, and every function on its stack
+    samples['count'] += 1
+    seen = set()
+    top = True
+    while frame is not None:
+        code = frame.f_code
+        name = "{0} ({1}:{2})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+        if top:
+            samples['self'][name] += 1
+            top = False
+        if name not in seen:
+            samples['total'][name] += 1
+            seen.add(name)
+        frame = frame.f_back
+
+# For example, watch a conversion, printing the progress every 10 seconds
+if __name__ == '__main__':
+    def print_progress(report):
+        print("{0:.1%} read, {1:.0f} s to go".format(report['fraction'], report['eta'] or 0))
+
+    start_metrics('conversion_metrics.jsonl', print_progress, interval=10, profile=0.01)
+    process_map(filename)
+    pprint.pprint(stop_metrics())
+
+
+# The json file is bigger than the osm file it came from, and every analysis of it parses all of it again.
+# process_map_columns writes the same documents to a column store instead, a directory with a file per column:
+# 
+# * id, type, lat, lon, version, changeset, timestamp, uid and user as fixed width numbers,
+# * every other field of a document as (key, value) pairs, with the address fields as "address.street" and so on,
+#   the lists, like the postcodes, as one "address.postcode[]" pair per item, and an empty address as "address{}",
+# * the node refs, with offsets saying where each document's refs start.
+# 
+# All of the strings (users, keys and values) are numbers into one table of distinct strings, kept in strings.json.
+# The documents are written in chunks, and each chunk of each column is compressed on its own, so a reader
+# memory-maps the column files and decompresses just the chunks of the columns it needs.
+
+# In[36]:
+
+import zlib
+import numpy as np
+
+column_types = OrderedDict([('id', np.int64), ('type', np.int8), ('lat', np.float64), ('lon', np.float64),
+                            ('version', np.int32), ('changeset', np.int64), ('timestamp', np.int64),
+                            ('uid', np.int64), ('user', np.int32), ('tag_offsets', np.int64),
+                            ('tag_keys', np.int32), ('tag_values', np.int32), ('ref_offsets', np.int64),
+                            ('refs', np.int64)])
+column_doc_types = ['node', 'way']
+# the numbers stored for a missing value
+missing_number = -1
+missing_time = np.iinfo(np.int64).min
+
+def string_table():
+    return {'codes': {}, 'strings': []}
+
+def string_code(table, value):
+    code = table['codes'].get(value)
+    if code is None:
+        code = table['codes'][value] = len(table['strings'])
+        table['strings'].append(value)
+    return code
+
+def flatten_fields(el, prefix, fields):
+    # the (key, value) pairs of a document's fields, other than the ones with columns of their own
+    for k, v in el.items():
+        if isinstance(v, dict):
+            if not v:
+                fields.append((prefix + k + '{}', None))
+            flatten_fields(v, prefix + k + '.', fields)
+        elif isinstance(v, list):
+            if not v:
+                fields.append((prefix + k + '[]', None))
+            for item in v:
+                fields.append((prefix + k + '[]', item))
+        elif isinstance(v, str):
+            fields.append((prefix + k, v))
+        else:
+            raise ValueError("the field {0} of {1} is not a string".format(prefix + k, el.get('id')))
+    return fields
+
+def new_column_chunk():
+    return dict((name, []) for name in column_types)
+
+def add_column_doc(chunk, table, el):
+    created = el.get('created', {})
+    pos = el.get('pos') or [None, None]
+    chunk['id'].append(int(el['id']))
+    chunk['type'].append(column_doc_types.index(el['type']))
+    chunk['lat'].append(np.nan if pos[0] is None else pos[0])
+    chunk['lon'].append(np.nan if pos[1] is None else pos[1])
+    for name in ['version', 'changeset', 'uid']:
+        chunk[name].append(int(created[name]) if name in created else missing_number)
+    # datetime64 reads the timestamps without the "Z", and NaT is missing
+    chunk['timestamp'].append(created['timestamp'][:-1] if 'timestamp' in created else 'NaT')
+    chunk['user'].append(string_code(table, created['user']) if 'user' in created else missing_number)
+    others = dict((k, v) for k, v in el.items() if k not in ('id', 'type', 'pos', 'created', 'node_refs'))
+    for k, v in flatten_fields(others, '', []):
+        chunk['tag_keys'].append(string_code(table, k))
+        chunk['tag_values'].append(missing_number if v is None else string_code(table, v))
+    chunk['tag_offsets'].append(len(chunk['tag_keys']))
+    chunk['refs'].extend(int(ref) for ref in el.get('node_refs', []))
+    chunk['ref_offsets'].append(len(chunk['refs']))
+
+def column_arrays(chunk):
+    arrays = {}
+    for name, dtype in column_types.items():
+        if name == 'timestamp':
+            stamps = np.array(chunk[name], dtype='datetime64[s]')
+            if not np.all(np.datetime_as_string(stamps) == np.array(chunk[name])):
+                raise ValueError("timestamps must look like 2013-08-03T16:43:42Z to be stored in columns")
+            arrays[name] = stamps.astype(np.int64)
+        elif name in ('tag_offsets', 'ref_offsets'):
+            # the offsets of the documents in the chunk, starting with 0
+            arrays[name] = np.array([0] + chunk[name], dtype=dtype)
+        else:
+            arrays[name] = np.array(chunk[name], dtype=dtype)
+    return arrays
+
+def write_column_chunk(store, chunk):
+    arrays = column_arrays(chunk)
+    entry = {'documents': len(chunk['id']), 'columns': {}}
+    for name, column in arrays.items():
+        data = column.tobytes()
+        if store['compress']:
+            data = zlib.compress(data, store['compress'])
+        f = store['files'][name]
+        entry['columns'][name] = [f.tell(), len(data)]
+        f.write(data)
+    store['meta']['chunks'].append(entry)
+
+def write_columns(docs, path, chunk_size = 1 << 16, compress = 1):
+    # compress is the zlib level for each chunk of each column, or 0 to store them as they are
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    table = string_table()
+    store = {'compress': compress, 'files': {},
+             'meta': {'columns': dict((name, np.dtype(dtype).str) for name, dtype in column_types.items()),
+                      'types': column_doc_types, 'compress': compress, 'chunks': []}}
+    try:
+        for name in column_types:
+            store['files'][name] = open(os.path.join(path, name + '.bin'), 'wb')
+        chunk = new_column_chunk()
+        for el in docs:
+            add_column_doc(chunk, table, el)
+            if len(chunk['id']) == chunk_size:
+                write_column_chunk(store, chunk)
+                chunk = new_column_chunk()
+        if chunk['id']:
+            write_column_chunk(store, chunk)
+    finally:
+        for f in store['files'].values():
+            f.close()
+    with open(os.path.join(path, 'strings.json'), 'w') as f:
+        json.dump(table['strings'], f)
+    meta = store['meta']
+    meta['documents'] = sum(entry['documents'] for entry in meta['chunks'])
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    return meta
+
+def process_map_columns(file_in, chunk_size = 1 << 16, compress = 1):
+    # like process_map, but to a column store next to the map file
+    rule_hits.clear()
+    meta = write_columns(shape_map(file_in), "{0}.columns".format(file_in), chunk_size, compress)
+    report_rule_hits()
+    return meta
+
+def open_columns(path):
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    with open(os.path.join(path, 'strings.json')) as f:
+        strings = json.load(f)
+    store = {'path': path, 'meta': meta, 'strings': np.array(strings, dtype=object), 'maps': {}}
+    for name in meta['columns']:
+        file_name = os.path.join(path, name + '.bin')
+        # an empty file cannot be mapped
+        store['maps'][name] = np.memmap(file_name, dtype=np.uint8, mode='r') if os.path.getsize(file_name) else None
+    return store
+
+def read_column(store, name, chunk):
+    offset, length = store['meta']['chunks'][chunk]['columns'][name]
+    dtype = np.dtype(store['meta']['columns'][name])
+    if not length:
+        return np.empty(0, dtype)
+    data = store['maps'][name][offset:offset + length]
+    if store['meta']['compress']:
+        return np.frombuffer(zlib.decompress(data), dtype)
+    return data.view(dtype)
+
+def scan_columns(store, names):
+    # for each chunk, a dictionary of the columns asked for
+    for chunk in range(len(store['meta']['chunks'])):
+        yield dict((name, read_column(store, name, chunk)) for name in names)
+
+def column_docs(store):
+    # the documents back again, with the same fields as the ones written (in their own order)
+    strings = store['strings']
+    for arrays in scan_columns(store, list(column_types)):
+        stamps = np.datetime_as_string(arrays['timestamp'].astype('datetime64[s]'))
+        for i in range(len(arrays['id'])):
+            el = {'id': str(arrays['id'][i]), 'type': store['meta']['types'][arrays['type'][i]]}
+            created = {}
+            for name in ['version', 'changeset', 'uid']:
+                if arrays[name][i] != missing_number:
+                    created[name] = str(arrays[name][i])
+            if arrays['timestamp'][i] != missing_time:
+                created['timestamp'] = stamps[i] + 'Z'
+            if arrays['user'][i] != missing_number:
+                created['user'] = strings[arrays['user'][i]]
+            if created:
+                el['created'] = created
+            pos = [arrays['lat'][i], arrays['lon'][i]]
+            if not (np.isnan(pos[0]) and np.isnan(pos[1])):
+                el['pos'] = [None if np.isnan(v) else float(v) for v in pos]
+            for j in range(arrays['tag_offsets'][i], arrays['tag_offsets'][i + 1]):
+                value = arrays['tag_values'][j]
+                unflatten_field(el, strings[arrays['tag_keys'][j]], None if value == missing_number else strings[value])
+            refs = arrays['refs'][arrays['ref_offsets'][i]:arrays['ref_offsets'][i + 1]]
+            if len(refs):
+                el['node_refs'] = [str(ref) for ref in refs]
+            yield el
+
+def unflatten_field(el, key, value):
+    # put a (key, value) pair of flatten_fields back into the document
+    fields = el
+    keys = key.split('.')
+    for key in keys[:-1]:
+        fields = fields.setdefault(key, {})
+    key = keys[-1]
+    if key.endswith('{}'):
+        fields.setdefault(key[:-2], {})
+    elif key.endswith('[]'):
+        items = fields.setdefault(key[:-2], [])
+        if value is not None:
+            items.append(value)
+    else:
+        fields[key] = value
+
+def top_codes(codes, strings, limit = None):
+    # like top_values: the most common first, the ties in the order they were first seen
+    if not len(codes):
+        return []
+    values, first, counts = np.unique(codes, return_index=True, return_counts=True)
+    order = np.lexsort((first, -counts))[:limit]
+    return [{"_id": strings[values[i]], "count": int(counts[i])} for i in order]
+
+def field_values(store, arrays, key):
+    # the value of a field of each document that has it, as string codes, and those documents' numbers
+    code = store['codes'].get(key)
+    if code is None:
+        return np.empty(0, np.int64), np.empty(0, np.int32)
+    at = np.nonzero(arrays['tag_keys'] == code)[0]
+    return np.searchsorted(arrays['tag_offsets'], at, side='right') - 1, arrays['tag_values'][at]
+
+def column_report(store):
+    # the report statistics of analyze_map, reading only the type, user and field columns
+    strings = store['strings']
+    store['codes'] = dict((s, i) for i, s in enumerate(strings))
+    parts = dict((name, []) for name in ['type', 'user', 'amenity', 'leisure', 'address.city', 'postcode'])
+    documents = 0
+    for arrays in scan_columns(store, ['type', 'user', 'tag_offsets', 'tag_keys', 'tag_values']):
+        parts['type'].append(arrays['type'])
+        parts['user'].append(arrays['user'])
+        for key in ['amenity', 'leisure', 'address.city']:
+            parts[key].append(field_values(store, arrays, key)[1])
+        # a postcode is a string, or a list of them; give each document's list one code of its own
+        docs, values = field_values(store, arrays, 'address.postcode')
+        list_docs, list_values = field_values(store, arrays, 'address.postcode[]')
+        postcodes = dict(zip(docs, (strings[v] for v in values)))
+        for doc, value in zip(list_docs, list_values):
+            postcodes.setdefault(doc, ())
+            postcodes[doc] += (strings[value],) if value != missing_number else ()
+        parts['postcode'].append([postcodes[doc] for doc in sorted(postcodes)])
+        documents += len(arrays['type'])
+    types = np.array(store['meta']['types'] + [None], dtype=object)
+    users = np.concatenate(parts['user']) if parts['user'] else np.empty(0, np.int32)
+    postcodes = [value for part in parts['postcode'] for value in part]
+    postcode_values = dict((value, i) for i, value in enumerate(sorted(set(postcodes), key=repr)))
+    postcode_table = np.array([None] * len(postcode_values), dtype=object)
+    for value, i in postcode_values.items():
+        postcode_table[i] = list(value) if isinstance(value, tuple) else value
+    # the missing users count as None, like in analyze_map
+    user_table = np.append(strings, None)
+    return {'documents': documents,
+            'unique users': {'count': int(len(np.unique(users[users >= 0])))},
+            'top contributing user': top_codes(users, user_table, 1),
+            'nodes and ways': top_codes(np.concatenate(parts['type']) if parts['type'] else [], types),
+            'top 10 amenities': top_codes(np.concatenate(parts['amenity']) if parts['amenity'] else [], strings, 10),
+            'top 10 leisures': top_codes(np.concatenate(parts['leisure']) if parts['leisure'] else [], strings, 10),
+            'zip codes': top_codes(np.array([postcode_values[value] for value in postcodes], dtype=np.int64),
+                                   postcode_table),
+            'cities': top_codes(np.concatenate(parts['address.city']) if parts['address.city'] else [], strings)}
+
+# For example, convert the map once, then count the report statistics from the columns
+if __name__ == '__main__':
+    pprint.pprint(process_map_columns(filename)['documents'])
+    pprint.pprint(column_report(open_columns("{0}.columns".format(filename))))
+
+
+# process_map returns a list of dictionaries, one per element, and a dictionary is big: each document has a dictionary
+# for "created" and one for "address", and its own copy of every user name, key and street name. The list takes
+# several times the size of the osm file. compact_map keeps the same documents in memory as slotted Node and Way
+# records instead:
+# 
+# * the fields of a document are the (key, value) pairs of the column store above, in the order of the document.
+#   The keys are a tuple of codes into one table of distinct strings, and most documents share the same tuple,
+#   which is kept in the table once,
+# * the values are an array of 4-byte codes into the same table, so a user or a street name is stored once.
+#   The values that are plain numbers, like the versions, changesets and uids, and the timestamps, which would
+#   fill the table with strings seen once, are kept in the array as negative numbers instead,
+# * the id is a number, and the position of a node is two floats,
+# * the node refs of a way are an array of 8-byte integers.
+# 
+# expand_element gives back the same dictionary, with the keys in the same order, so its json line is the same too.
+
+# In[41]:
+
+import calendar
+from array import array
+
+class Node(object):
+    __slots__ = ('id', 'lat', 'lon', 'keys', 'values')
+
+    def __init__(self, id, lat, lon, keys, values):
+        self.id = id
+        self.lat = lat
+        self.lon = lon
+        self.keys = keys
+        self.values = values
+
+class Way(object):
+    __slots__ = ('id', 'keys', 'values', 'node_refs')
+
+    def __init__(self, id, keys, values, node_refs):
+        self.id = id
+        self.keys = keys
+        self.values = values
+        self.node_refs = node_refs
+
+# the largest number kept in a value, the rest are strings
+max_value_number = (1 << 31) - 3
+timestamp_re = re.compile(r'\d{4}-\d\d-\d\dT\d\d:\d\d:\d\dZ$')
+
+def plain_number(value):
+    # whether the string reads back from its number, like the ids and node refs of an osm file.
+    # isdigit alone is also true of '²' or '①', which int cannot read
+    return isinstance(value, str) and value.isascii() and value.isdigit() and str(int(value)) == value
+
+def format_timestamp(seconds):
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(seconds))
+
+def encode_value(table, key, value):
+    # a string code, or -1 for None, or -2 - n for the number n
+    if value is None:
+        return missing_number
+    if key == 'created.timestamp':
+        if timestamp_re.match(value):
+            seconds = calendar.timegm((int(value[:4]), int(value[5:7]), int(value[8:10]), int(value[11:13]),
+                                       int(value[14:16]), int(value[17:19])))
+            if 0 <= seconds <= max_value_number and format_timestamp(seconds) == value:
+                return -2 - seconds
+    elif plain_number(value) and int(value) <= max_value_number:
+        return -2 - int(value)
+    return string_code(table, value)
+
+def decode_value(strings, key, value):
+    if value >= 0:
+        return strings[value]
+    if value == missing_number:
+        return None
+    if key == 'created.timestamp':
+        return format_timestamp(-2 - value)
+    return str(-2 - value)
+
+def shared_keys(table, keys):
+    # the one copy of this tuple of key codes
+    keys = tuple(keys)
+    return table.setdefault('keys', {}).setdefault(keys, keys)
+
+def compact_element(table, el):
+    # the record of a document. The id, the pos and the node refs are in the keys with no value,
+    # so they go back in the same place.
+    keys = []
+    values = array('i')
+    element_id = lat = lon = refs = None
+    for k, v in el.items():
+        if k == 'id' and plain_number(v):
+            element_id = int(v)
+            value = missing_number
+        elif k == 'pos' and isinstance(v, list):
+            lat, lon = v
+            value = missing_number
+        elif k == 'node_refs' and isinstance(v, list):
+            if not all(plain_number(ref) for ref in v):
+                raise ValueError("the node refs of {0} are not all numbers".format(el.get('id')))
+            refs = array('q', [int(ref) for ref in v])
+            value = missing_number
+        elif isinstance(v, str):
+            value = encode_value(table, k, v)
+        else:
+            for key, item in flatten_fields({k: v}, '', []):
+                keys.append(string_code(table, key))
+                values.append(encode_value(table, key, item))
+            continue
+        keys.append(string_code(table, k))
+        values.append(value)
+    keys = shared_keys(table, keys)
+    if refs is None:
+        return Node(element_id, lat, lon, keys, values)
+    if 'pos' in el:
+        raise ValueError("{0} has both a pos and node refs".format(el.get('id')))
+    return Way(element_id, keys, values, refs)
+
+def expand_element(table, record):
+    strings = table['strings']
+    el = {}
+    for key_code, value in zip(record.keys, record.values):
+        key = strings[key_code]
+        if value == missing_number and key == 'id':
+            el['id'] = str(record.id)
+        elif value == missing_number and key == 'pos':
+            el['pos'] = [record.lat, record.lon]
+        elif value == missing_number and key == 'node_refs':
+            el['node_refs'] = [str(ref) for ref in record.node_refs]
+        else:
+            unflatten_field(el, key, decode_value(strings, key, value))
+    return el
+
+def compact_map(file_in, table = None, region = None):
+    # the records of the shaped documents, and the string table they need to be expanded
+    if table is None:
+        table = string_table()
+    records = [compact_element(table, el) for el in shape_map(file_in, region=region)]
+    return records, table
+
+def expand_map(records, table):
+    for record in records:
+        yield expand_element(table, record)
+
+# For example, keep the documents compactly, and write the json file from them
+if __name__ == '__main__':
+    records, table = compact_map(filename)
+    with open("{0}.json".format(filename), 'w') as fo:
+        for el in expand_map(records, table):
+            fo.write(to_json_line(el))
+
+
+# Shaping the elements is pure CPU work, but the conversion above runs on one core.
+# To use all the cores, split the file into byte ranges that each start at a top-level <node, <way or <relation tag.
+# Worker processes parse, shape and serialize their own range, and the results are written in the original order,
+# so the json file is byte for byte the same as the one written by process_map.
+# The workers are forked: started any other way, each would import this notebook again and rerun all of its cells.
+
+# In[18]:
+
+import io
+import os
+import multiprocessing
+
+def fork_context():
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        raise ValueError("the worker processes are forked, which this system does not do")
+    return multiprocessing.get_context('fork')
+
+element_start_re = re.compile(br'<(?:node|way|relation)[\s/>]')
+
+def next_element_start(f, offset, block_size = 1 << 16):
+    f.seek(offset)
+    buf = b''
+    while True:
+        block = f.read(block_size)
+        if not block:
+            return None
+        buf += block
+        m = element_start_re.search(buf)
+        if m:
+            return offset + m.start()
+        # keep the tail, in case a tag is split across two blocks
+        offset += len(buf) - 16
+        buf = buf[-16:]
+
+def end_of_elements(f, block_size = 1 << 16):
+    size = os.fstat(f.fileno()).st_size
+    f.seek(max(0, size - block_size))
+    tail = f.read()
+    return size - len(tail) + tail.rfind(b'</osm>')
+
+def split_map(file_in, chunk_size = 1 << 23, start = 0):
+    # byte ranges [start, end) covering every node, way and relation in the file, from the first one at start on
+    with open(file_in, 'rb') as f:
+        end = end_of_elements(f)
+        start = next_element_start(f, start)
+        while start is not None and start < end:
+            stop = next_element_start(f, start + chunk_size)
+            if stop is None or stop > end:
+                stop = end
+            yield (start, stop)
+            start = stop
+
+def convert_chunk(args):
+    file_in, start, end, pretty = args
+    with open(file_in, 'rb') as f:
+        f.seek(start)
+        raw = f.read(end - start)
+    lines = []
+    rule_hits.clear()
+    for record in iter_records(io.BytesIO(b'<osm>' + raw + b'</osm>')):
+        el = shape_record(record)
+        if el:
+            lines.append(to_json_line(el, pretty))
+    return ''.join(lines), len(lines), dict(rule_hits)
+
+def process_map_parallel(file_in, pretty = False, processes = None, chunk_size = 1 << 23):
+    file_out = "{0}.json".format(file_in)
+    chunks = ((file_in, start, end, pretty) for start, end in split_map(file_in, chunk_size))
+    pool = fork_context().Pool(processes or multiprocessing.cpu_count())
+    count = 0
+    hits = Counter()
+    try:
+        with codecs.open(file_out, "w") as fo:
+            # imap hands back the results in the order of the chunks
+            for text, n, chunk_hits in pool.imap(convert_chunk, chunks):
+                fo.write(text)
+                count += n
+                hits.update(chunk_hits)
+    finally:
+        pool.close()
+        pool.join()
+    rule_hits.clear()
+    rule_hits.update(hits)
+    report_rule_hits()
+    return count
+
+
+# A state-sized extract takes hours to convert, and if the process dies on the way, process_map starts over from
+# the first element. process_map_resumable converts the file in the byte ranges of split_map instead, and every
+# interval seconds, once a range is written out, it saves a checkpoint next to the json file:
+# 
+# * where the next range starts in the map file, and the size and modification time of the map file,
+# * how much of the json file is written, and the type and id of the last document in it,
+# * the rule hits so far, and the statistics of count_document, when they are being counted.
+# 
+# With resume, it starts from the checkpoint: the json file is cut back to where the checkpoint was saved, which
+# drops whatever was written after it, and the conversion goes on from the range after. The json file comes out
+# byte for byte the same as that of an uninterrupted run. The way geometry and the regions need the elements before
+# the checkpoint, so they are left to process_map.
+
+# In[40]:
+
+def checkpoint_file(file_out):
+    return file_out + '.checkpoint'
+
+def save_checkpoint(file_out, checkpoint):
+    # written under another name and then renamed, so a crash never leaves half a checkpoint
+    name = checkpoint_file(file_out)
+    with open(name + '.tmp', 'wb') as f:
+        pickle.dump(checkpoint, f, pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(name + '.tmp', name)
+
+def load_checkpoint(file_in, file_out):
+    # the checkpoint of a conversion of this file, or None to start from the beginning
+    if not os.path.exists(checkpoint_file(file_out)):
+        return None
+    with open(checkpoint_file(file_out), 'rb') as f:
+        checkpoint = pickle.load(f)
+    if checkpoint['map'] != file_stamp(file_in):
+        raise ValueError("{0} changed since the checkpoint was saved".format(file_in))
+    if os.path.getsize(file_out) < checkpoint['output offset']:
+        raise ValueError("{0} is shorter than when the checkpoint was saved".format(file_out))
+    if checkpoint['last'] is not None:
+        # the line ending at the output offset is the last document of the checkpoint
+        with open(file_out, 'rb') as f:
+            f.seek(max(0, checkpoint['output offset'] - (1 << 20)))
+            tail = f.read(checkpoint['output offset'] - f.tell())
+        last = json.loads(tail.splitlines()[-1].decode('ascii'))
+        if (last['type'], last['id']) != checkpoint['last']:
+            raise ValueError("{0} does not end with the last document of the checkpoint".format(file_out))
+    return checkpoint
+
+def process_map_resumable(file_in, resume = False, stats = None, interval = 60.0, chunk_size = 1 << 23):
+    # like process_map, but returning the number of documents written. With resume, stats gets the statistics of
+    # the checkpoint, and the ones of the rest of the file are counted into it.
+    if file_in.endswith('.pbf'):
+        raise ValueError("only osm xml files can be converted from a checkpoint")
+    file_out = "{0}.json".format(file_in)
+    checkpoint = load_checkpoint(file_in, file_out) if resume else None
+    if checkpoint is None:
+        checkpoint = {'map': file_stamp(file_in), 'input offset': 0, 'output offset': 0, 'last': None,
+                      'documents': 0, 'rule hits': {}, 'stats': None}
+    rule_hits.clear()
+    rule_hits.update(checkpoint['rule hits'])
+    if stats is not None and checkpoint['stats'] is not None:
+        stats.clear()
+        stats.update(checkpoint['stats'])
+    count = checkpoint['documents']
+    last = checkpoint['last']
+    saved = time.time()
+    with open(file_out, 'r+b' if checkpoint['output offset'] else 'wb') as fo:
+        fo.truncate(checkpoint['output offset'])
+        fo.seek(checkpoint['output offset'])
+        for start, end in split_map(file_in, chunk_size, checkpoint['input offset']):
+            with open(file_in, 'rb') as f:
+                f.seek(start)
+                raw = f.read(end - start)
+            lines = []
+            for record in iter_records(io.BytesIO(b'<osm>' + raw + b'</osm>')):
+                el = shape_record(record)
+                if el:
+                    lines.append(json_line_bytes(el))
+                    if stats is not None:
+                        count_document(stats, el)
+                    last = (el['type'], el['id'])
+            fo.write(b''.join(lines))
+            count += len(lines)
+            if time.time() - saved >= interval:
+                # the documents must be on disk before the checkpoint that counts them
+                fo.flush()
+                os.fsync(fo.fileno())
+                save_checkpoint(file_out, {'map': checkpoint['map'], 'input offset': end,
+                                           'output offset': fo.tell(), 'last': last, 'documents': count,
+                                           'rule hits': dict(rule_hits), 'stats': stats})
+                saved = time.time()
+    if os.path.exists(checkpoint_file(file_out)):
+        os.remove(checkpoint_file(file_out))
+    report_rule_hits()
+    return count
+
+# For example, convert the map saving a checkpoint every minute; after a crash, run it again with resume
+if __name__ == '__main__':
+    pprint.pprint(process_map_resumable(filename, resume=True))
+
+
+# process_map does one thing at a time: it parses an element, shapes it, serializes it, writes it, and only then
+# reads the next one, so the disk sits idle while the CPU works and the other way around.
+# pipeline_map writes the same json file with each stage in a thread of its own: the parser, the shaping
+# (and the way geometry), the json encoding, and the writing, which is done by the caller's thread.
+# The stages hand each other batches of documents through small bounded queues, so a slow stage holds up the ones
+# before it instead of filling the memory, and the documents come out in the order of the file.
+# 
+# The threads share one interpreter, so the gain is in the waiting: while a batch is written to a slow disk,
+# or compressed for a .json.gz or .json.zst file, the next ones are already being parsed and shaped.
+# The file is written in large blocks, byte for byte the same as the one of process_map. With encoder='orjson'
+# (or json_encoder set to it), the lines are encoded faster with orjson instead. Those leave out the spaces after
+# the separators and write the non-ASCII characters as they are, so the file differs, but every line reads back
+# into the same document.
+
+# In[37]:
+
+import gzip
+import threading
+import queue
+import time
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+def json_line_bytes(el, pretty = False):
+    # json.dumps escapes everything that is not ASCII
+    return to_json_line(el, pretty).encode('ascii')
+
+def orjson_line_bytes(el, pretty = False):
+    # orjson only indents by 2 in its own way, so the pretty output stays with json
+    if pretty:
+        return json_line_bytes(el, pretty)
+    try:
+        return orjson.dumps(el, option=orjson.OPT_APPEND_NEWLINE)
+    except TypeError:
+        # numbers of more than 64 bits
+        return json_line_bytes(el)
+
+json_encoders = OrderedDict([('json', json_line_bytes), ('orjson', orjson_line_bytes)])
+# json writes the same file as the other conversions, orjson only when asked for
+json_encoder = 'json'
+
+def pick_encoder(encoder = None):
+    encoder = encoder or json_encoder
+    if encoder == 'orjson' and orjson is None:
+        raise ValueError("the orjson encoder needs orjson installed")
+    return json_encoders[encoder]
+
+def open_output(file_out, compression = None, buffer_size = 1 << 20):
+    # a binary file to write to, with the extension of its compression added to the name
+    if compression is None:
+        return open(file_out, 'wb', buffering=buffer_size)
+    if compression == 'gzip':
+        return gzip.open(file_out + '.gz', 'wb', compresslevel=6)
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ValueError("zstd output needs zstandard installed")
+        return zstandard.ZstdCompressor().stream_writer(open(file_out + '.zst', 'wb', buffering=buffer_size))
+    raise ValueError("unknown compression {0}".format(compression))
+
+def pipe_batches(batches, stop):
+    # the batches coming down a queue, until the stage before is done or the pipeline is stopped
+    while not stop.is_set():
+        try:
+            batch = batches.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if batch is None:
+            return
+        yield batch
+
+def pipe_items(batches, stop):
+    for batch in pipe_batches(batches, stop):
+        for item in batch:
+            yield item
+
+def pipe_put(batches, batch, stop):
+    while not stop.is_set():
+        try:
+            batches.put(batch, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def pipe_stage(name, items, batches, stop, errors, batch_size):
+    # put the items on the queue in batches, then None when they are done.
+    # With the metrics on, the stage's timer is the CPU time of its thread, which leaves out the waiting.
+    start = time.thread_time()
+    batch = []
+    try:
+        for item in items:
+            batch.append(item)
+            if len(batch) == batch_size:
+                if not pipe_put(batches, batch, stop):
+                    return
+                batch = []
+                if metrics['enabled']:
+                    metrics['timers'][name] = time.thread_time() - start
+        if batch:
+            pipe_put(batches, batch, stop)
+        pipe_put(batches, None, stop)
+    except Exception as e:
+        errors.append(e)
+        stop.set()
+    finally:
+        if metrics['enabled']:
+            metrics['timers'][name] = time.thread_time() - start
+
+def pipeline_map(file_in, pretty = False, geometry = False, compression = None, encoder = None,
+                 batch_size = 1000, depth = 4, region = None, relations = False):
+    # like stream_map: write the json file, and yield the shaped documents one at a time
+    file_out = "{0}.json".format(file_in)
+    encode = pick_encoder(encoder)
+    stop = threading.Event()
+    errors = []
+    records, shaped, lines = [queue.Queue(maxsize=depth) for i in range(3)]
+
+    if metrics['enabled']:
+        parsed = instrumented_records(file_in, region=region)
+    else:
+        parsed = iter_records(file_in, region=region)
+    docs = (shape_record(record, relations) for record in pipe_items(records, stop))
+    docs = (el for el in docs if el)
+    if geometry:
+        nodes = node_store()
+        docs = with_way_geometry(docs, nodes)
+        if relations:
+            docs = with_relation_rings(docs, nodes)
+    encoded = ((batch, b''.join([encode(el, pretty) for el in batch])) for batch in pipe_batches(shaped, stop))
+    stages = [('parse', parsed, records, batch_size), ('shape', docs, shaped, batch_size),
+              ('json', encoded, lines, 1)]
+    threads = [threading.Thread(target=pipe_stage, args=(name, items, batches, stop, errors, size))
+               for name, items, batches, size in stages]
+
+    rule_hits.clear()
+    if metrics['enabled']:
+        # the threads time their own stages, so the geometry is in the shaping, and no stage includes another
+        metrics['threaded stages'] = True
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        with open_output(file_out, compression) as fo:
+            write = timed_call('write', fo.write) if metrics['enabled'] else fo.write
+            for batch, data in pipe_items(lines, stop):
+                write(data)
+                for el in batch:
+                    yield el
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+    report_rule_hits()
+
+# For example, convert the map to a gzipped json file
+if __name__ == '__main__':
+    pprint.pprint(len(process_map(filename, compression='gzip')))
+
+
+# ## Regional extracts
 
+# Often only a part of the metro extract is wanted, a city or the area of a postcode. Shaping every element and
+# throwing most of them away afterwards costs the whole conversion. With a region, iter_records keeps only what is
+# in it, before any tag is looked at, so process_map, shape_map, audit and run_audits on a slice cost about
+# the parsing of the file.
+# 
+# A region is a bounding box [min lat, min lon, max lat, max lon], or a polygon, a list of [lat, lon] points.
+# The nodes are kept by their lat and lon attributes. The file lists the nodes first, so by the time the ways come,
+# the ids of the kept nodes are known, and a way is kept when any of its nodes is (as a whole, with the node refs
+# outside too). Then a relation is kept when any of its members is. A relation can have a member relation that
+# comes after it in the file, so a relation not kept by then, but with member relations, waits until the end of
+# the file; it is kept, after all the others, when one of its member relations is. The kept ids are held in sorted
+# arrays of 8-byte integers, which is far smaller than a set for the millions of nodes of a city.
+
+# In[38]:
+
+import numbers
+from array import array
+from bisect import bisect_left
+
+def make_region(region):
+    # the region as a tuple, which can key the audit cache: 4 numbers for a bounding box, or the polygon's points
+    try:
+        if len(region) == 4 and all(isinstance(x, numbers.Real) for x in region):
+            box = tuple(float(x) for x in region)
+            if box[0] > box[2] or box[1] > box[3]:
+                raise ValueError("the bounding box {0} is not [min lat, min lon, max lat, max lon]".format(region))
+            return box
+        polygon = tuple((float(lat), float(lon)) for lat, lon in region)
+    except TypeError:
+        raise ValueError("a region is a bounding box or a list of [lat, lon] points, not {0!r}".format(region))
+    if len(polygon) < 3:
+        raise ValueError("a polygon needs at least 3 points")
+    return polygon
+
+def point_in_polygon(lat, lon, polygon):
+    # count the edges crossed by a ray from the point towards growing longitudes
+    inside = False
+    lat1, lon1 = polygon[-1]
+    for lat2, lon2 in polygon:
+        if (lat1 > lat) != (lat2 > lat) and lon < lon1 + (lat - lat1) * (lon2 - lon1) / (lat2 - lat1):
+            inside = not inside
+        lat1, lon1 = lat2, lon2
+    return inside
+
+def region_test(region):
+    # a function telling whether a lat and lon are in the region
+    region = make_region(region)
+    if isinstance(region[0], float):
+        min_lat, min_lon, max_lat, max_lon = region
+        return lambda lat, lon: min_lat <= lat <= max_lat and min_lon <= lon <= max_lon
+    lats = [lat for lat, lon in region]
+    lons = [lon for lat, lon in region]
+    min_lat, min_lon, max_lat, max_lon = min(lats), min(lons), max(lats), max(lons)
+    # most of the nodes are outside even the polygon's bounding box, which is quicker to test
+    return lambda lat, lon: (min_lat <= lat <= max_lat and min_lon <= lon <= max_lon and
+                             point_in_polygon(lat, lon, region))
+
+def has_any(ids, refs):
+    # whether any of the refs is in the sorted array of ids
+    count = len(ids)
+    for ref in refs:
+        ref = int(ref)
+        at = bisect_left(ids, ref)
+        if at < count and ids[at] == ref:
+            return True
+    return False
+
+def region_records(records, region):
+    # the records in the region; the root and the bounds are kept as they are
+    inside = region_test(region)
+    kept = {'node': array('q'), 'way': array('q'), 'relation': array('q')}
+    unsorted = set()
+
+    def kept_ids(kind):
+        # osm files list the elements by id, so the array is usually sorted already
+        if kind in unsorted:
+            kept[kind] = array('q', sorted(kept[kind]))
+            unsorted.discard(kind)
+        return kept[kind]
+
+    def keep_id(kind, element_id):
+        ids = kept[kind]
+        element_id = int(element_id)
+        if ids and element_id < ids[-1]:
+            unsorted.add(kind)
+        ids.append(element_id)
+
+    waiting = []
+    for record in records:
+        tag, attrib = record[0], record[1]
+        if tag == 'node':
+            if 'lat' not in attrib or 'lon' not in attrib or not inside(float(attrib['lat']), float(attrib['lon'])):
+                continue
+        elif tag == 'way':
+            if not has_any(kept_ids('node'), record[3]):
+                continue
+        elif tag == 'relation':
+            if not any(kind in kept and has_any(kept_ids(kind), [ref]) for kind, ref, role in record[4]):
+                if any(kind == 'relation' for kind, ref, role in record[4]):
+                    waiting.append(record)
+                continue
+        if tag in kept:
+            keep_id(tag, attrib['id'])
+        yield record
+    # each relation kept can keep more of the waiting ones
+    while waiting:
+        ids = kept_ids('relation')
+        now = [any(kind == 'relation' and has_any(ids, [ref]) for kind, ref, role in record[4]) for record in waiting]
+        if not any(now):
+            break
+        for record, keep in zip(waiting, now):
+            if keep:
+                keep_id('relation', record[1]['id'])
+                yield record
+        waiting = [record for record, keep in zip(waiting, now) if not keep]
+
+# For example, audit the street names of downtown San Jose only
+if __name__ == '__main__':
+    downtown = [37.325, -121.900, 37.345, -121.875]
+    pprint.pprint(dict(audit(filename, street_type_re, expected_names, region=downtown)))
+
+
+
+# ## Reading PBF extracts
+
+# The metro extracts are also published as .osm.pbf, which is 5-10 times smaller than the xml and much faster to decode.
+# A PBF file is a sequence of blobs: a 4-byte length, a BlobHeader, then a Blob holding a zlib-compressed PrimitiveBlock.
+# Each blob can be decoded on its own, so the blobs are decoded in a process pool into the same records
+# the xml parsers give, so the conversion and the audits work on them unchanged.
+# The messages are small enough to read the protocol buffer wire format directly.
+# https://wiki.openstreetmap.org/wiki/PBF_Format
+
+# In[20]:
+
+import struct
+import zlib
+import time
+from collections import deque
+
+pbf_features = ["OsmSchema-V0.6", "DenseNodes", "HistoricalInformation"]
+member_types = ["node", "way", "relation"]
+
+def read_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+def read_fields(buf):
+    # yield (field number, value) for each field of a message; length-delimited values are returned as bytes
+    pos = 0
+    while pos < len(buf):
+        key, pos = read_varint(buf, pos)
+        wire_type = key & 7
+        if wire_type == 0:
+            value, pos = read_varint(buf, pos)
+        elif wire_type == 2:
+            length, pos = read_varint(buf, pos)
+            value = buf[pos:pos + length]
+            pos += length
+        elif wire_type == 1:
+            value = buf[pos:pos + 8]
+            pos += 8
+        elif wire_type == 5:
+            value = buf[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError("unsupported protobuf wire type {0}".format(wire_type))
+        yield key >> 3, value
+
+def to_signed(n):
+    # int32/int64 fields store negative numbers as 64-bit two's complement
+    if n >= 1 << 63:
+        n -= 1 << 64
+    return n
+
+def unzigzag(n):
+    return (n >> 1) ^ -(n & 1)
+
+def read_packed(buf, zigzag = False):
+    values = []
+    pos = 0
+    while pos < len(buf):
+        value, pos = read_varint(buf, pos)
+        values.append(unzigzag(value) if zigzag else to_signed(value))
+    return values
+
+def undelta(values):
+    total = 0
+    result = []
+    for value in values:
+        total += value
+        result.append(total)
+    return result
+
+def read_blobs(file_in):
+    # the raw OSMData blobs of the file (a file name or a binary file object),
+    # checking the OSMHeader for features we cannot read
+    f = open(file_in, 'rb') if isinstance(file_in, str) else file_in
+    try:
+        while True:
+            size = f.read(4)
+            if len(size) < 4:
+                return
+            blob_type, datasize = None, 0
+            for field, value in read_fields(bytearray(f.read(struct.unpack('>i', size)[0]))):
+                if field == 1:
+                    blob_type = bytes(value).decode('ascii')
+                elif field == 3:
+                    datasize = value
+            blob = f.read(datasize)
+            if blob_type == "OSMHeader":
+                for field, value in read_fields(blob_data(blob)):
+                    if field == 4 and bytes(value).decode('utf-8') not in pbf_features:
+                        raise ValueError("unsupported PBF feature {0}".format(bytes(value).decode('utf-8')))
+            elif blob_type == "OSMData":
+                yield blob
+    finally:
+        if f is not file_in:
+            f.close()
+
+def blob_data(blob):
+    for field, value in read_fields(bytearray(blob)):
+        if field == 1:
+            return value
+        elif field == 3:
+            return bytearray(zlib.decompress(bytes(value)))
+    raise ValueError("unsupported PBF blob compression")
+
+def format_info(attrib, version, timestamp, changeset, uid, user, visible, block):
+    # the attributes in the same text form, and the same order, as the osm xml
+    if visible is not None:
+        attrib['visible'] = "true" if visible else "false"
+    if version != -1:
+        attrib['version'] = str(version)
+    if changeset:
+        attrib['changeset'] = str(changeset)
+    if timestamp:
+        attrib['timestamp'] = time.strftime("%Y-%m-%dT%H:%M:%SZ",
+                                            time.gmtime(timestamp * block['date_granularity'] // 1000))
+    if user:
+        attrib['user'] = block['strings'][user]
+        attrib['uid'] = str(uid)
+
+def format_coordinate(value, offset, block):
+    return "{0:.7f}".format((offset + block['granularity'] * value) / 1e9)
+
+def read_info(buf, attrib, block):
+    info = {1: -1, 2: 0, 3: 0, 4: 0, 5: 0, 6: None}
+    for field, value in read_fields(buf):
+        info[field] = to_signed(value) if field != 6 else bool(value)
+    format_info(attrib, info[1], info[2], info[3], info[4], info[5], info[6], block)
+
+def read_tags(keys, vals, block):
+    return [(block['strings'][k], block['strings'][v]) for k, v in zip(keys, vals)]
+
+def decode_dense(buf, block):
+    ids, lats, lons, keys_vals = [], [], [], []
+    dense_info = None
+    for field, value in read_fields(buf):
+        if field == 1:
+            ids = undelta(read_packed(value, zigzag=True))
+        elif field == 5:
+            dense_info = value
+        elif field == 8:
+            lats = undelta(read_packed(value, zigzag=True))
+        elif field == 9:
+            lons = undelta(read_packed(value, zigzag=True))
+        elif field == 10:
+            keys_vals = read_packed(value)
+    # version, timestamp, changeset, uid, user and visible of every node
+    infos = {1: [-1] * len(ids), 2: [0] * len(ids), 3: [0] * len(ids), 4: [0] * len(ids), 5: [0] * len(ids),
+             6: [None] * len(ids)}
+    if dense_info is not None:
+        for field, value in read_fields(dense_info):
+            if field == 1:
+                infos[field] = read_packed(value)
+            elif field in (2, 3, 4, 5):
+                infos[field] = undelta(read_packed(value, zigzag=True))
+            elif field == 6:
+                infos[field] = [bool(v) for v in read_packed(value)]
+    records = []
+    kv = 0
+    for i, node_id in enumerate(ids):
+        attrib = {'id': str(node_id)}
+        format_info(attrib, infos[1][i], infos[2][i], infos[3][i], infos[4][i], infos[5][i], infos[6][i], block)
+        attrib['lat'] = format_coordinate(lats[i], block['lat_offset'], block)
+        attrib['lon'] = format_coordinate(lons[i], block['lon_offset'], block)
+        tags = []
+        # keys and values of all the nodes, each node's list ends with a 0
+        while kv < len(keys_vals) and keys_vals[kv] != 0:
+            tags.append((block['strings'][keys_vals[kv]], block['strings'][keys_vals[kv + 1]]))
+            kv += 2
+        kv += 1
+        records.append(('node', attrib, tags, [], []))
+    return records
+
+def decode_element(tag, buf, block):
+    attrib = {}
+    keys, vals, refs, roles, memids, types = [], [], [], [], [], []
+    lat = lon = None
+    for field, value in read_fields(buf):
+        if field == 1:
+            attrib['id'] = str(to_signed(value) if tag != 'node' else unzigzag(value))
+        elif field == 2:
+            keys = read_packed(value)
+        elif field == 3:
+            vals = read_packed(value)
+        elif field == 4:
+            read_info(value, attrib, block)
+        elif field == 8 and tag == 'node':
+            lat = unzigzag(value)
+        elif field == 9 and tag == 'node':
+            lon = unzigzag(value)
+        elif field == 8 and tag == 'way':
+            refs = [str(ref) for ref in undelta(read_packed(value, zigzag=True))]
+        elif field == 8:
+            roles = read_packed(value)
+        elif field == 9:
+            memids = undelta(read_packed(value, zigzag=True))
+        elif field == 10:
+            types = read_packed(value)
+    if lat is not None:
+        attrib['lat'] = format_coordinate(lat, block['lat_offset'], block)
+        attrib['lon'] = format_coordinate(lon, block['lon_offset'], block)
+    members = [(member_types[t], str(ref), block['strings'][role]) for t, ref, role in zip(types, memids, roles)]
+    return (tag, attrib, read_tags(keys, vals, block), refs, members)
+
+def decode_blob(blob):
+    # decode one PrimitiveBlock into plain (tag, attrib, tags, node refs, members) records,
+    # which are cheap to send back from the worker processes
+    buf = blob_data(blob)
+    block = {'strings': [], 'granularity': 100, 'lat_offset': 0, 'lon_offset': 0, 'date_granularity': 1000}
+    groups = []
+    for field, value in read_fields(buf):
+        if field == 1:
+            block['strings'] = [bytes(s).decode('utf-8') for f, s in read_fields(value) if f == 1]
+        elif field == 2:
+            groups.append(value)
+        elif field == 17:
+            block['granularity'] = value
+        elif field == 18:
+            block['date_granularity'] = value
+        elif field == 19:
+            block['lat_offset'] = to_signed(value)
+        elif field == 20:
+            block['lon_offset'] = to_signed(value)
+    records = []
+    for group in groups:
+        for field, value in read_fields(group):
+            if field == 1:
+                records.append(decode_element('node', value, block))
+            elif field == 2:
+                records.extend(decode_dense(value, block))
+            elif field == 3:
+                records.append(decode_element('way', value, block))
+            elif field == 4:
+                records.append(decode_element('relation', value, block))
+    return records
+
+def iter_pbf_records(file_in, processes = None):
+    # the records of the elements, like the xml parsers give. Only a few blobs are decoded ahead of the
+    # consumer, so memory stays bounded for large files.
+    processes = processes or multiprocessing.cpu_count()
+    pool = fork_context().Pool(processes)
+    pending = deque()
+    try:
+        blobs = read_blobs(file_in)
+        while True:
+            for blob in blobs:
+                pending.append(pool.apply_async(decode_blob, (blob,)))
+                if len(pending) > 2 * processes:
+                    break
+            if not pending:
+                break
+            for record in pending.popleft().get():
+                yield record
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+# ## Way geometry
+
+# The ways only have the ids of their nodes, so their length, center or extent need a lookup of every node.
+# The nodes come before the ways in the map file, so while converting, keep the coordinates of every node in
+# sorted numpy arrays: an int64 id and the latitude and longitude as int32 in 1e-7 degrees, the precision of the osm
+# file. That is 16 bytes per node, where a dictionary of strings would take gigabytes for a large state.
+# If there are more nodes than fit in memory, the arrays are written to disk and memory-mapped instead.
+# Should they then be out of order, sorting them would need them all in memory, so they are sorted out of core:
+# dealt out by id into buckets of about max_memory_nodes, and each bucket sorted on its own and written back.
+# The node refs of a batch of ways are then looked up all at once with searchsorted, and each way gets
+# 
+# * "geometry": the [lat, lon] of its nodes, leaving out nodes outside the extract,
+# * "centroid": the mean [lat, lon] of those nodes,
+# * "bbox": [min lat, min lon, max lat, max lon].
+
+# In[30]:
+
+import numpy as np
+import tempfile
+import shutil
+
+def node_store(max_memory_nodes = 1 << 26, chunk_size = 1 << 16, spill_dir = None):
+    return {'max_memory_nodes': max_memory_nodes, 'chunk_size': chunk_size, 'spill_dir': spill_dir,
+            'pending': ([], [], []), 'chunks': [], 'count': 0, 'files': None, 'index': None}
+
+def add_node(store, node_id, lat, lon):
+    ids, lats, lons = store['pending']
+    ids.append(int(node_id))
+    lats.append(lat)
+    lons.append(lon)
+    if len(ids) == store['chunk_size']:
+        flush_nodes(store)
+
+def flush_nodes(store):
+    ids, lats, lons = store['pending']
+    if not ids:
+        return
+    chunk = (np.array(ids, dtype=np.int64),
+             np.round(np.array(lats) * 1e7).astype(np.int32),
+             np.round(np.array(lons) * 1e7).astype(np.int32))
+    store['pending'] = ([], [], [])
+    store['count'] += len(chunk[0])
+    store['chunks'].append(chunk)
+    if store['files'] is None and store['count'] > store['max_memory_nodes']:
+        # too many to keep in memory, move them to disk from now on
+        directory = tempfile.mkdtemp(dir=store['spill_dir'])
+        store['files'] = [os.path.join(directory, name) for name in ['ids', 'lats', 'lons']]
+    if store['files'] is not None:
+        for chunk in store['chunks']:
+            for column, name in zip(chunk, store['files']):
+                with open(name, 'ab') as f:
+                    column.tofile(f)
+        store['chunks'] = []
+
+def sort_spilled_nodes(store, index):
+    ids = index[0]
+    buckets = -(-len(ids) // store['max_memory_nodes'])
+    # the bucket bounds are quantiles of a sample of the ids
+    sample = np.sort(ids[::max(1, len(ids) // 100000)])
+    bounds = sample[np.arange(1, buckets) * len(sample) // buckets]
+    directory = tempfile.mkdtemp(dir=store['spill_dir'])
+    try:
+        names = [[os.path.join(directory, '{0}.{1}'.format(name, bucket)) for name in ['ids', 'lats', 'lons']]
+                 for bucket in range(buckets)]
+        files = [[open(name, 'wb') for name in bucket_names] for bucket_names in names]
+        try:
+            step = store['chunk_size']
+            for start in range(0, len(ids), step):
+                chunk = [column[start:start + step] for column in index]
+                # a stable sort by bucket, so the nodes of a bucket stay in the order of the file
+                bucket = np.searchsorted(bounds, chunk[0], side='right')
+                order = np.argsort(bucket, kind='mergesort')
+                splits = np.searchsorted(bucket[order], np.arange(buckets + 1))
+                for i in range(buckets):
+                    rows = order[splits[i]:splits[i + 1]]
+                    for column, f in zip(chunk, files[i]):
+                        column[rows].tofile(f)
+        finally:
+            for bucket_files in files:
+                for f in bucket_files:
+                    f.close()
+        start = 0
+        for bucket_names in names:
+            bucket = [np.fromfile(name, dtype=column.dtype) for name, column in zip(bucket_names, index)]
+            order = np.argsort(bucket[0], kind='mergesort')
+            for column, values in zip(index, bucket):
+                column[start:start + len(order)] = values[order]
+            start += len(order)
+            for name in bucket_names:
+                os.remove(name)
+    finally:
+        shutil.rmtree(directory)
+
+def finalize_nodes(store):
+    flush_nodes(store)
+    if store['files'] is not None:
+        index = [np.memmap(name, dtype=dtype, mode='r+')
+                 for name, dtype in zip(store['files'], [np.int64, np.int32, np.int32])]
+        # the mapping stays valid after the files are removed
+        shutil.rmtree(os.path.dirname(store['files'][0]))
+    elif store['chunks']:
+        index = [np.concatenate([chunk[i] for chunk in store['chunks']]) for i in range(3)]
+    else:
+        index = [np.empty(0, np.int64), np.empty(0, np.int32), np.empty(0, np.int32)]
+    store['chunks'] = []
+    ids, lats, lons = index
+    # osm files list the nodes by id, so this is usually already sorted
+    if len(ids) and not np.all(ids[1:] >= ids[:-1]):
+        if store['files'] is not None:
+            sort_spilled_nodes(store, index)
+        else:
+            order = np.argsort(ids, kind='mergesort')
+            for column in index:
+                column[:] = column[order]
+    store['index'] = index
+
+def resolve_refs(store, refs_lists):
+    # the latitudes and longitudes of the nodes of each way, leaving out the nodes we do not have
+    ids, lats, lons = store['index']
+    lengths = [len(refs) for refs in refs_lists]
+    refs = np.array([int(ref) for refs in refs_lists for ref in refs], dtype=np.int64)
+    if not len(ids):
+        return [(np.empty(0), np.empty(0)) for refs in refs_lists]
+    at = np.minimum(np.searchsorted(ids, refs), len(ids) - 1)
+    found = ids[at] == refs
+    lat = lats[at] / 1e7
+    lon = lons[at] / 1e7
+    result = []
+    start = 0
+    for length in lengths:
+        keep = found[start:start + length]
+        result.append((lat[start:start + length][keep], lon[start:start + length][keep]))
+        start += length
+    return result
+
+def add_geometry(store, ways):
+    if not ways:
+        return ways
+    for way, (lat, lon) in zip(ways, resolve_refs(store, [way.get('node_refs', []) for way in ways])):
+        if len(lat):
+            way['geometry'] = [[float(a), float(b)] for a, b in zip(lat, lon)]
+            way['centroid'] = [float(lat.mean()), float(lon.mean())]
+            way['bbox'] = [float(lat.min()), float(lon.min()), float(lat.max()), float(lon.max())]
+    return ways
+
+def with_way_geometry(docs, store = None, batch_size = 1000):
+    # index the nodes as they go by, and add the geometry to the ways in batches, keeping the order of the documents.
+    # Nodes that come after the first way are not indexed.
+    if store is None:
+        store = node_store()
+    ways = []
+    for el in docs:
+        if el['type'] == 'way':
+            if store['index'] is None:
+                finalize_nodes(store)
+            ways.append(el)
+            if len(ways) == batch_size:
+                for way in add_geometry(store, ways):
+                    yield way
+                ways = []
+            continue
+        for way in add_geometry(store, ways):
+            yield way
+        ways = []
+        if el['type'] == 'node' and store['index'] is None and None not in el.get('pos', [None]):
+            add_node(store, el['id'], el['pos'][0], el['pos'][1])
+        yield el
+    for way in add_geometry(store, ways):
+        yield way
+
+
+# ## Relations
+
+# The relations hold what the nodes and ways cannot: the boundaries of the cities and parks, buildings with
+# courtyards, and the bus routes. With relations, shape_map shapes them like the ways, with their type tag as
+# "relation_type" and their "members", a list of {"type", "ref", "role"}.
+# 
+# With geometry too, the multipolygon and boundary relations get their rings. A relation needs the node refs of its
+# member ways, which come long before it in the file, and keeping every way in memory would take gigabytes for a state.
+# So while the ways go by, their node refs are written to an index like the one of the node coordinates: sorted way
+# ids, and the refs of each way one after another, moved to disk and memory-mapped when there are too many.
+# Once the relations come, the member ways of each one are looked up in the index, joined end to end into closed
+# rings, and the rings looked up in the node coordinates. Only the relation at hand is kept in memory, so the memory
+# stays bounded by the two indexes. Each such relation gets
+# 
+# * "outer" and "inner": its rings, each a list of [lat, lon], the first point repeated at the end; the members with
+#   no role count as outer,
+# * "centroid" and "bbox" of its outer rings, like the ways,
+# * "incomplete": true, when member ways or nodes are outside the extract, or the ways do not close into rings.
+
+# In[42]:
+
+ring_relation_types = ['multipolygon', 'boundary']
+
+def way_store(max_memory_refs = 1 << 24, chunk_size = 1 << 16, spill_dir = None):
+    return {'max_memory_refs': max_memory_refs, 'chunk_size': chunk_size, 'spill_dir': spill_dir,
+            'pending': ([], [], []), 'chunks': [], 'refs count': 0, 'files': None, 'index': None}
+
+def add_way(store, way_id, refs):
+    ids, lengths, all_refs = store['pending']
+    ids.append(int(way_id))
+    lengths.append(len(refs))
+    all_refs.extend(int(ref) for ref in refs)
+    if len(ids) == store['chunk_size']:
+        flush_ways(store)
+
+def flush_ways(store):
+    ids, lengths, refs = store['pending']
+    if not ids:
+        return
+    chunk = (np.array(ids, dtype=np.int64), np.array(lengths, dtype=np.int64), np.array(refs, dtype=np.int64))
+    store['pending'] = ([], [], [])
+    store['refs count'] += len(chunk[2])
+    store['chunks'].append(chunk)
+    if store['files'] is None and store['refs count'] > store['max_memory_refs']:
+        directory = tempfile.mkdtemp(dir=store['spill_dir'])
+        store['files'] = [os.path.join(directory, name) for name in ['ids', 'lengths', 'refs']]
+    if store['files'] is not None:
+        for chunk in store['chunks']:
+            for column, name in zip(chunk, store['files']):
+                with open(name, 'ab') as f:
+                    column.tofile(f)
+        store['chunks'] = []
+
+def finalize_ways(store):
+    flush_ways(store)
+    if store['files'] is not None:
+        index = [np.memmap(name, dtype=np.int64, mode='r') if os.path.getsize(name) else np.empty(0, np.int64)
+                 for name in store['files']]
+        shutil.rmtree(os.path.dirname(store['files'][0]))
+    elif store['chunks']:
+        index = [np.concatenate([chunk[i] for chunk in store['chunks']]) for i in range(3)]
+    else:
+        index = [np.empty(0, np.int64) for i in range(3)]
+    store['chunks'] = []
+    ids, lengths, refs = index
+    offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    # the refs stay in the order of the file, so the ids are sorted with the place of each one's refs
+    order = None
+    if len(ids) and not np.all(ids[1:] >= ids[:-1]):
+        order = np.argsort(ids, kind='mergesort')
+        ids = ids[order]
+    store['index'] = (ids, order, offsets, refs)
+
+def way_refs(store, way_ids):
+    # the node refs of each way, as a list of numbers, or None for the ways we do not have
+    ids, order, offsets, refs = store['index']
+    way_ids = np.array([int(way_id) for way_id in way_ids], dtype=np.int64)
+    if not len(ids) or not len(way_ids):
+        return [None] * len(way_ids)
+    at = np.minimum(np.searchsorted(ids, way_ids), len(ids) - 1)
+    found = ids[at] == way_ids
+    if order is not None:
+        at = order[at]
+    return [refs[offsets[i]:offsets[i + 1]].tolist() if ok else None for i, ok in zip(at, found)]
+
+def assemble_rings(segments):
+    # join the node ref lists end to end, turning them around where needed, into closed rings.
+    # The rings, and the lists that could not be closed.
+    segments = [segment for segment in segments if len(segment) >= 2]
+    ends = defaultdict(set)
+    for i, segment in enumerate(segments):
+        ends[segment[0]].add(i)
+        ends[segment[-1]].add(i)
+    used = set()
+    rings, open_rings = [], []
+    for i, segment in enumerate(segments):
+        if i in used:
+            continue
+        used.add(i)
+        ends[segment[0]].discard(i)
+        ends[segment[-1]].discard(i)
+        ring = list(segment)
+        while ring[0] != ring[-1] and ends[ring[-1]]:
+            j = min(ends[ring[-1]])
+            used.add(j)
+            following = segments[j]
+            ends[following[0]].discard(j)
+            ends[following[-1]].discard(j)
+            ring.extend(following[1:] if following[0] == ring[-1] else following[-2::-1])
+        if ring[0] == ring[-1] and len(ring) >= 4:
+            rings.append(ring)
+        else:
+            open_rings.append(ring)
+    return rings, open_rings
+
+def add_rings(nodes, ways, el):
+    incomplete = False
+    rings = {'outer': [], 'inner': []}
+    for role in rings:
+        member_ids = [m['ref'] for m in el.get('members', []) if m['type'] == 'way' and
+                      (m['role'] or 'outer') == role]
+        segments = way_refs(ways, member_ids)
+        incomplete = incomplete or None in segments
+        closed, open_rings = assemble_rings([segment for segment in segments if segment is not None])
+        incomplete = incomplete or bool(open_rings)
+        for ref_list, (lat, lon) in zip(closed, resolve_refs(nodes, closed)):
+            if len(lat) != len(ref_list):
+                incomplete = True
+            if len(lat) >= 4:
+                rings[role].append([[float(a), float(b)] for a, b in zip(lat, lon)])
+    el['outer'] = rings['outer']
+    el['inner'] = rings['inner']
+    points = [point for ring in rings['outer'] for point in ring[:-1]]
+    if points:
+        lat = np.array([point[0] for point in points])
+        lon = np.array([point[1] for point in points])
+        el['centroid'] = [float(lat.mean()), float(lon.mean())]
+        el['bbox'] = [float(lat.min()), float(lon.min()), float(lat.max()), float(lon.max())]
+    if incomplete:
+        el['incomplete'] = True
+    return el
+
+def with_relation_rings(docs, nodes, ways = None):
+    # index the node refs of the ways as they go by, and add the rings to the relations.
+    # nodes is the store of with_way_geometry, which indexes the node coordinates before the ways.
+    # Ways that come after the first relation are not indexed.
+    if ways is None:
+        ways = way_store()
+    for el in docs:
+        if el['type'] == 'way' and ways['index'] is None:
+            add_way(ways, el['id'], el.get('node_refs', []))
+        elif el['type'] == 'relation':
+            if ways['index'] is None:
+                finalize_ways(ways)
+            if nodes['index'] is None:
+                finalize_nodes(nodes)
+            if el.get('relation_type') in ring_relation_types:
+                add_rings(nodes, ways, el)
+        yield el
+
+# For example, the boundaries in the map, and their size
+if __name__ == '__main__':
+    for el in shape_map(filename, geometry=True, relations=True):
+        if el.get('relation_type') == 'boundary':
+            print(el.get('name'), el.get('bbox'), el.get('incomplete', False))
 
 
 # ## Overview of the data
@@ -464,12 +2621,99 @@ def process_map(file_in, pretty = False):
 
 import os
 file_size = os.path.getsize("san-jose_california.osm.json")
-print file_size
+print(file_size)
 
 
 # Converted json file: 297 MB.
 
 # Then, I ran mongoimport in command prompt, and imported the json file. 
+# 
+# That means every document is serialized, written, read back and parsed again. Instead, load_map shapes the documents
+# and inserts them straight into the collection. The documents are inserted in batches with unordered insert_many,
+# by a few writer threads sharing the connection pool of one MongoClient. The batches wait in a bounded queue,
+# so the parser slows down when the database cannot keep up.
+# 
+# Every query below would scan the whole collection, so after loading, load_map also creates indexes for them,
+# and a 2dsphere index on a GeoJSON "location" made from "pos".
+
+# In[20]:
+
+import threading
+import queue
+import time
+from pymongo import ASCENDING, GEOSPHERE, IndexModel
+
+report_indexes = [
+    IndexModel([("created.user", ASCENDING)]),
+    IndexModel([("type", ASCENDING), ("created.user", ASCENDING)]),
+    IndexModel([("amenity", ASCENDING)], sparse=True),
+    IndexModel([("leisure", ASCENDING)], sparse=True),
+    IndexModel([("address.postcode", ASCENDING), ("address.city", ASCENDING)], sparse=True),
+    IndexModel([("address.city", ASCENDING)], sparse=True),
+    IndexModel([("location", GEOSPHERE)])
+]
+
+def add_location(el):
+    # GeoJSON points are [longitude, latitude], while pos is [latitude, longitude].
+    # Ways converted with geometry are located at their centroid.
+    pos = el.get('pos') or el.get('centroid')
+    if pos and None not in pos:
+        el['location'] = {"type": "Point", "coordinates": [pos[1], pos[0]]}
+    return el
+
+def load_map(file_in, collection, batch_size = 1000, writers = 4, indexes = True, geometry = False, relations = False,
+             region = None):
+    batches = queue.Queue(maxsize = 2 * writers)
+    errors = []
+
+    def write_batches():
+        while True:
+            batch = batches.get()
+            if batch is None:
+                return
+            try:
+                collection.insert_many(batch, ordered=False)
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=write_batches) for i in range(writers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    start = time.time()
+    count = 0
+    batch = []
+    rule_hits.clear()
+    try:
+        for el in shape_map(file_in, geometry, region, relations):
+            batch.append(add_location(el))
+            if len(batch) == batch_size:
+                batches.put(batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            batches.put(batch)
+            count += len(batch)
+    finally:
+        for thread in threads:
+            batches.put(None)
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+    report_rule_hits()
+    # building the indexes once after the bulk load is much faster than keeping them up to date while inserting
+    if indexes:
+        collection.create_indexes(report_indexes)
+    # the cached reports of the collection are out of date
+    bump_collection_version(collection)
+
+    seconds = time.time() - start
+    stats = {"documents": count, "seconds": seconds, "documents per second": count / seconds if seconds else 0}
+    pprint.pprint(stats)
+    return stats
+
 # Now that is done, I can run queries to obtain some statistics.
 
 #  #### Number of Documents
@@ -483,14 +2727,61 @@ db_name = "osm"
 client = MongoClient('localhost:27017')
 db = client[db_name]
 san_jose = db['sanjose']
-san_jose.find().count()
 
+if __name__ == '__main__':
+    # load the collection again, straight from the map file
+    san_jose.drop()
+    load_map(filename, san_jose)
+
+san_jose.count_documents({})
+
+
+# Each query below is registered here, so that at the end I can check with explain() that they all use an index.
+
+# In[27]:
+
+from bson.son import SON
+
+report_queries = []
+
+def register_pipeline(name, pipeline):
+    # a pipeline for aggregate(), or a command document such as distinct
+    report_queries.append((name, pipeline))
+
+def find_stages(explain, stage):
+    # every plan stage of this kind, anywhere in the output of explain()
+    found = []
+    if isinstance(explain, dict):
+        if explain.get('stage') == stage:
+            found.append(explain)
+        for value in explain.values():
+            found += find_stages(value, stage)
+    elif isinstance(explain, list):
+        for value in explain:
+            found += find_stages(value, stage)
+    return found
+
+def advise_indexes(db, collection_name = 'sanjose'):
+    report = {}
+    for name, query in report_queries:
+        if isinstance(query, list):
+            explain = db.command('aggregate', collection_name, pipeline=query, explain=True)
+        else:
+            explain = db.command('explain', query)
+        if find_stages(explain, 'COLLSCAN'):
+            report[name] = 'collection scan'
+        else:
+            report[name] = 'index'
+    pprint.pprint(report)
+    return report
 
 
 # #### Number of Unique Users
 
 # In[22]:
 
+register_pipeline('unique users', SON([("distinct", "sanjose"), ("key", "created.user")]))
+
 len(san_jose.distinct('created.user'))
 
 
@@ -500,12 +2791,40 @@ len(san_jose.distinct('created.user'))
 
 # In[23]:
 
-pipeline = [{"$group" : {"_id" : "$created.user", "count" : {"$sum" : 1}}}, 
+# sorting on the user first lets MongoDB group straight from the created.user index
+pipeline = [{"$sort" : {"created.user" : 1}},
+            {"$group" : {"_id" : "$created.user", "count" : {"$sum" : 1}}}, 
             {"$sort" : {"count" : -1}}, 
             {"$limit" : 1}]
-
-def aggregate(db, pipeline):
-    return [doc for doc in db.sanjose.aggregate(pipeline)]
+register_pipeline('top contributing user', pipeline)
+
+# The results are cached by the pipeline and the version of the collection (see "Auditing the Data" above),
+# which load_map and apply_changes bump in the collection_versions collection. Anything else that changes the
+# collection should bump it too.
+def collection_version(collection):
+    doc = collection.database['collection_versions'].find_one({'_id': collection.name})
+    return doc['version'] if doc else 0
+
+def bump_collection_version(collection):
+    collection.database['collection_versions'].update_one({'_id': collection.name}, {'$inc': {'version': 1}},
+                                                          upsert=True)
+
+def canonical_pipeline(pipeline):
+    # the pipeline as compact json. The order of the keys is kept, since it matters to stages like $sort.
+    return json.dumps(pipeline, separators=(',', ':'), default=str)
+
+def aggregate(db, pipeline, cache = True):
+    collection = db.sanjose
+    if cache:
+        key = cache_key('aggregate', collection.full_name, collection_version(collection),
+                        canonical_pipeline(pipeline))
+        result = cache_get(key)
+        if result is not cache_miss:
+            return result
+    result = [doc for doc in collection.aggregate(pipeline)]
+    if cache:
+        cache_put(key, result)
+    return result
 
 if __name__ == '__main__':
     result = aggregate(db, pipeline)
@@ -516,7 +2835,9 @@ if __name__ == '__main__':
 
 # In[24]:
 
-pipeline = [{"$group" : {"_id" : "$type", "count" : {"$sum" : 1}}}]
+pipeline = [{"$sort" : {"type" : 1}},
+            {"$group" : {"_id" : "$type", "count" : {"$sum" : 1}}}]
+register_pipeline('nodes and ways', pipeline)
 
 if __name__ == '__main__':
     result = aggregate(db, pipeline)
@@ -531,6 +2852,7 @@ pipeline = [{"$match" : {"amenity" : {"$exists" : 1}}},
             {"$group" : {"_id" : "$amenity", "count" : {"$sum" : 1}}}, 
             {"$sort" : {"count" : -1}}, 
             {"$limit" : 10}]
+register_pipeline('top 10 amenities', pipeline)
  
 if __name__ == '__main__':
     result = aggregate(db, pipeline)
@@ -547,6 +2869,7 @@ pipeline = [{"$match" : {"leisure" : {"$exists" : 1}}},
             {"$group" : {"_id" : "$leisure", "count" : {"$sum" : 1}}}, 
             {"$sort" : {"count" : -1}}, 
             {"$limit" : 10}]
+register_pipeline('top 10 leisures', pipeline)
 if __name__ == '__main__':
     result = aggregate(db, pipeline)
     pprint.pprint(result)
@@ -563,6 +2886,7 @@ if __name__ == '__main__':
 pipeline = [{"$match": {"address.postcode": {"$exists": 1}}},
             {"$group": {"_id": "$address.postcode", "count": {"$sum": 1}}},
             {"$sort": {"count": -1}}]
+register_pipeline('zip codes', pipeline)
 
 if __name__ == '__main__':
     result = aggregate(db, pipeline)
@@ -577,6 +2901,7 @@ if __name__ == '__main__':
 pipeline = [{"$match" : {"address.city" : {"$exists" : 1}}}, 
             {"$group" : {"_id" : "$address.city", "count" : {"$sum" : 1}}}, 
             {"$sort" : {"count" : -1}}]
+register_pipeline('cities', pipeline)
             
 
 if __name__ == '__main__':
@@ -584,6 +2909,174 @@ if __name__ == '__main__':
     pprint.pprint(result)
 
 
+# #### Do the queries use the indexes?
+
+# In[28]:
+
+# flags every query above that still scans the whole collection
+if __name__ == '__main__':
+    advise_indexes(db)
+
+
+# #### The same statistics without the database
+
+# All of the statistics above can also be counted while converting the map, without loading it into MongoDB first.
+# The counts are exact as long as there are not too many distinct values to keep. Past that, the unique users are
+# estimated with a HyperLogLog, and the top values with a Space-Saving summary, and each such result carries an "error":
+# 
+# * for the unique users, the relative standard error of the estimate,
+# * for a top value, how much its count may be overestimated.
+# 
+# https://en.wikipedia.org/wiki/HyperLogLog <br>
+# Metwally et al., "Efficient Computation of Frequent and Top-k Elements in Data Streams"
+
+# In[29]:
+
+import hashlib
+import math
+
+def unique_counter(max_exact = 100000, p = 14):
+    return {'values': set(), 'registers': None, 'p': p, 'max_exact': max_exact}
+
+def hll_add(counter, value):
+    # the first p bits of the hash pick the register, which keeps the longest run of leading zeros seen in the rest
+    h = int(hashlib.sha1(value.encode('utf-8')).hexdigest()[:16], 16)
+    p = counter['p']
+    rest = h & ((1 << (64 - p)) - 1)
+    rank = (64 - p) - rest.bit_length() + 1
+    index = h >> (64 - p)
+    if counter['registers'][index] < rank:
+        counter['registers'][index] = rank
+
+def add_unique(counter, value):
+    if counter['registers'] is not None:
+        hll_add(counter, value)
+        return
+    counter['values'].add(value)
+    if len(counter['values']) > counter['max_exact']:
+        counter['registers'] = bytearray(1 << counter['p'])
+        for v in counter['values']:
+            hll_add(counter, v)
+        counter['values'] = None
+
+def count_unique(counter):
+    if counter['registers'] is None:
+        return {'count': len(counter['values'])}
+    m = 1 << counter['p']
+    alpha = 0.7213 / (1 + 1.079 / m)
+    estimate = alpha * m * m / sum(2.0 ** -r for r in counter['registers'])
+    zeros = counter['registers'].count(b'\0')
+    if estimate <= 2.5 * m and zeros:
+        # small cardinalities are estimated better from the empty registers
+        estimate = m * math.log(float(m) / zeros)
+    return {'count': int(round(estimate)), 'error': 1.04 / math.sqrt(m)}
+
+def top_counter(max_exact = 100000, capacity = 1000):
+    return {'counts': {}, 'errors': None, 'buckets': None, 'min': 0,
+            'max_exact': max_exact, 'capacity': capacity}
+
+def start_space_saving(counter):
+    # keep the largest counts. Any value dropped here has a count no larger than the smallest one kept,
+    # which is all the Space-Saving bounds need.
+    kept = sorted(counter['counts'].items(), key=lambda item: item[1], reverse=True)[:counter['capacity']]
+    counter['counts'] = dict(kept)
+    counter['errors'] = dict((value, 0) for value, count in kept)
+    # the values grouped by count, so the smallest count is found without a scan
+    counter['buckets'] = defaultdict(set)
+    for value, count in kept:
+        counter['buckets'][count].add(value)
+    counter['min'] = kept[-1][1]
+
+def move_value(counter, value, count):
+    buckets = counter['buckets']
+    old = counter['counts'].get(value)
+    if old is not None:
+        buckets[old].discard(value)
+        if not buckets[old]:
+            del buckets[old]
+    counter['counts'][value] = count
+    buckets[count].add(value)
+    while counter['min'] not in buckets:
+        counter['min'] += 1
+
+def count_value(counter, value):
+    if isinstance(value, list):
+        value = tuple(value)
+    counts = counter['counts']
+    if counter['buckets'] is None:
+        counts[value] = counts.get(value, 0) + 1
+        if len(counts) > counter['max_exact']:
+            start_space_saving(counter)
+    elif value in counts:
+        move_value(counter, value, counts[value] + 1)
+    else:
+        # replace a value with the smallest count, which may be all the new value's count was
+        smallest = counter['min']
+        evicted = counter['buckets'][smallest].pop()
+        if not counter['buckets'][smallest]:
+            del counter['buckets'][smallest]
+        del counts[evicted]
+        del counter['errors'][evicted]
+        counter['errors'][value] = smallest
+        move_value(counter, value, smallest + 1)
+
+def top_values(counter, limit = None):
+    # like the $group, $sort and $limit pipelines: [{"_id": value, "count": count}, ...]
+    result = []
+    for value, count in sorted(counter['counts'].items(), key=lambda item: item[1], reverse=True)[:limit]:
+        doc = {"_id": list(value) if isinstance(value, tuple) else value, "count": count}
+        if counter['errors'] is not None:
+            doc["error"] = counter['errors'][value]
+        result.append(doc)
+    return result
+
+def new_report_stats(max_exact = 100000, capacity = 1000):
+    stats = {'documents': 0, 'users': unique_counter(max_exact)}
+    for name in ['user counts', 'types', 'amenities', 'leisures', 'postcodes', 'cities']:
+        stats[name] = top_counter(max_exact, capacity)
+    return stats
+
+def count_document(stats, el):
+    stats['documents'] += 1
+    user = el.get('created', {}).get('user')
+    if user is not None:
+        add_unique(stats['users'], user)
+    count_value(stats['user counts'], user)
+    count_value(stats['types'], el['type'])
+    if 'amenity' in el:
+        count_value(stats['amenities'], el['amenity'])
+    if 'leisure' in el:
+        count_value(stats['leisures'], el['leisure'])
+    address = el.get('address', {})
+    if 'postcode' in address:
+        count_value(stats['postcodes'], address['postcode'])
+    if 'city' in address:
+        count_value(stats['cities'], address['city'])
+
+def report_stats(stats):
+    return {'documents': stats['documents'],
+            'unique users': count_unique(stats['users']),
+            'top contributing user': top_values(stats['user counts'], 1),
+            'nodes and ways': top_values(stats['types']),
+            'top 10 amenities': top_values(stats['amenities'], 10),
+            'top 10 leisures': top_values(stats['leisures'], 10),
+            'zip codes': top_values(stats['postcodes']),
+            'cities': top_values(stats['cities'])}
+
+def analyze_map(file_in, max_exact = 100000, capacity = 1000):
+    stats = new_report_stats(max_exact, capacity)
+    for el in shape_map(file_in):
+        count_document(stats, el)
+    return report_stats(stats)
+
+# count the statistics while writing the json file
+if __name__ == '__main__':
+    stats = new_report_stats()
+    for el in stream_map(filename):
+        count_document(stats, el)
+    pprint.pprint(report_stats(stats))
+
+
 # Based on the results for zip codes and cities, I noticed a few things:
 # 
 # 1. Cities have quite a few problems. 
@@ -603,8 +3096,1169 @@ if __name__ == '__main__':
 # 
 # For improvement 3, the challenges would be how to propose the new feature to the OpenStreetMap community, what changes need to be done to the API, how are we going to test the new feature, and how are we going to let the new feature to be known by the San Jose user community.
 
+# ### Nearby parking
+
+# To try out improvement 3 without a live geo query, here is a small spatial index over the documents' pos
+# (or the centroid of a way converted with geometry). The points are projected to meters around the middle latitude
+# of the index, which is accurate enough within a metro area.
+# 
+# * The points are bucketed in a grid of square cells, so the points in a bounding box or a radius come from
+#   a few contiguous ranges of the points sorted by cell.
+# * A KD-tree answers the k nearest neighbour queries. Its leaves hold a few dozen points, and the distances to them
+#   are computed with numpy all at once.
+# * Batches of k nearest neighbour queries, like the nearest parking for every restaurant, go through the grid
+#   instead: all the points in the cells around all the queries are gathered and sorted together. A query is done
+#   once its k-th nearest point is closer than the edge of the cells searched; the others search twice as wide a ring
+#   of cells, and the few still left after that use the KD-tree.
+# 
+# The index is a dictionary of numpy arrays, so it can be saved to and loaded from a .npz file.
+
+# In[31]:
+
+earth_radius = 6371008.8
+
+def project(index, lat, lon):
+    # meters east and north on a plane tangent at the middle latitude of the index
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    lon = np.radians(np.asarray(lon, dtype=np.float64))
+    return lon * np.cos(index['lat0']) * earth_radius, lat * earth_radius
+
+def cell_keys(index, x, y):
+    cx = np.floor(np.asarray(x) / index['cell_size']).astype(np.int64)
+    cy = np.floor(np.asarray(y) / index['cell_size']).astype(np.int64)
+    return (cx << 32) + (cy + (1 << 31))
+
+def build_kdtree(index, leaf_size):
+    # the points are reordered so that every tree node covers a contiguous range of them
+    points = np.column_stack([index['x'], index['y']])
+    order = np.arange(len(points))
+    nodes = []
+    stack = [(0, len(points), -1, False)]
+    while stack:
+        start, end, parent, is_right = stack.pop()
+        node = len(nodes)
+        nodes.append([start, end, -1, 0.0, -1, -1])
+        if parent >= 0:
+            nodes[parent][5 if is_right else 4] = node
+        if end - start <= leaf_size:
+            continue
+        extent = points[order[start:end]].max(axis=0) - points[order[start:end]].min(axis=0)
+        axis = int(np.argmax(extent))
+        middle = (start + end) // 2
+        part = np.argpartition(points[order[start:end], axis], middle - start)
+        order[start:end] = order[start:end][part]
+        nodes[node][2] = axis
+        nodes[node][3] = float(points[order[middle], axis])
+        stack.append((middle, end, node, True))
+        stack.append((start, middle, node, False))
+    nodes = np.array(nodes, dtype=np.float64).reshape(-1, 6)
+    index['tree_order'] = order
+    index['tree_range'] = nodes[:, :2].astype(np.int64)
+    index['tree_axis'] = nodes[:, 2].astype(np.int64)
+    index['tree_split'] = nodes[:, 3]
+    index['tree_children'] = nodes[:, 4:].astype(np.int64)
+
+def build_spatial_index(docs, cell_size = None, leaf_size = 32):
+    ids, types, lats, lons = [], [], [], []
+    for el in docs:
+        pos = el.get('pos') or el.get('centroid')
+        if pos and None not in pos:
+            ids.append(el['id'])
+            types.append(el['type'])
+            lats.append(pos[0])
+            lons.append(pos[1])
+    return build_point_index(np.array(ids), np.array(types), lats, lons, cell_size, leaf_size)
+
+def auto_cell_size(index, target = 4.0):
+    # start with cells that would hold target points if the points were spread evenly, then halve them while
+    # the points crowd together, until the cell of an average point holds about target points
+    n = len(index['x'])
+    if not n:
+        return 1.0
+    area = np.ptp(index['x']) * np.ptp(index['y'])
+    cell_size = max(np.sqrt(target * area / n), 1.0)
+    while cell_size > 1.0:
+        index['cell_size'] = cell_size
+        counts = np.unique(cell_keys(index, index['x'], index['y']), return_counts=True)[1].astype(np.float64)
+        if (counts ** 2).sum() / n <= 2 * target:
+            break
+        cell_size = max(cell_size / 2, 1.0)
+    return cell_size
+
+def build_point_index(ids, types, lats, lons, cell_size = None, leaf_size = 32):
+    index = {'ids': ids, 'types': types,
+             'lat': np.asarray(lats, dtype=np.float64), 'lon': np.asarray(lons, dtype=np.float64)}
+    index['lat0'] = float(np.radians(np.mean(index['lat']))) if len(index['lat']) else 0.0
+    index['x'], index['y'] = project(index, index['lat'], index['lon'])
+    index['cell_size'] = float(cell_size or auto_cell_size(index))
+    keys = cell_keys(index, index['x'], index['y'])
+    index['grid_order'] = np.argsort(keys, kind='mergesort')
+    index['grid_keys'] = keys[index['grid_order']]
+    # the occupied cells, and where their points are in grid_order
+    index['cell_keys'], index['cell_starts'], index['cell_counts'] = np.unique(index['grid_keys'], return_index=True,
+                                                                               return_counts=True)
+    build_kdtree(index, leaf_size)
+    return index
+
+def save_spatial_index(index, path):
+    np.savez(path, **index)
+
+def load_spatial_index(path):
+    data = np.load(path)
+    index = dict((name, data[name]) for name in data.files)
+    for name in ['lat0', 'cell_size']:
+        index[name] = float(index[name])
+    return index
+
+def spatial_results(index, points, distances = None):
+    results = []
+    for i, point in enumerate(points):
+        result = {'id': index['ids'][point].item(), 'type': index['types'][point].item(),
+                  'pos': [float(index['lat'][point]), float(index['lon'][point])]}
+        if distances is not None:
+            result['distance'] = float(distances[i])
+        results.append(result)
+    return results
+
+def grid_candidates(index, x0, y0, x1, y1):
+    # the points in the grid cells that overlap the rectangle; each column of cells is one range of grid_keys
+    cx0, cx1 = [int(np.floor(v / index['cell_size'])) for v in (x0, x1)]
+    cy0, cy1 = [int(np.floor(v / index['cell_size'])) + (1 << 31) for v in (y0, y1)]
+    ranges = []
+    for cx in range(cx0, cx1 + 1):
+        start = np.searchsorted(index['grid_keys'], (cx << 32) + cy0, side='left')
+        end = np.searchsorted(index['grid_keys'], (cx << 32) + cy1, side='right')
+        if end > start:
+            ranges.append(index['grid_order'][start:end])
+    return np.concatenate(ranges) if ranges else np.empty(0, dtype=np.int64)
+
+def within_bbox(index, bbox):
+    # bbox is [min lat, min lon, max lat, max lon], as on the ways
+    x0, y0 = project(index, bbox[0], bbox[1])
+    x1, y1 = project(index, bbox[2], bbox[3])
+    points = grid_candidates(index, x0, y0, x1, y1)
+    inside = ((index['lat'][points] >= bbox[0]) & (index['lat'][points] <= bbox[2]) &
+              (index['lon'][points] >= bbox[1]) & (index['lon'][points] <= bbox[3]))
+    return spatial_results(index, points[inside])
+
+def within_radius(index, lat, lon, meters):
+    x, y = project(index, lat, lon)
+    points = grid_candidates(index, x - meters, y - meters, x + meters, y + meters)
+    distances = np.hypot(index['x'][points] - x, index['y'][points] - y)
+    order = np.argsort(distances)
+    order = order[distances[order] <= meters]
+    return spatial_results(index, points[order], distances[order])
+
+def nearest_points(index, x, y, k):
+    best_points = np.empty(0, dtype=np.int64)
+    best_distances = np.empty(0)
+    stack = [0]
+    while stack:
+        node = stack.pop()
+        start, end = index['tree_range'][node]
+        left, right = index['tree_children'][node]
+        if left < 0:
+            points = index['tree_order'][start:end]
+            distances = np.hypot(index['x'][points] - x, index['y'][points] - y)
+            best_points = np.concatenate([best_points, points])
+            best_distances = np.concatenate([best_distances, distances])
+            if len(best_points) > k:
+                keep = np.argpartition(best_distances, k - 1)[:k]
+                best_points, best_distances = best_points[keep], best_distances[keep]
+            continue
+        diff = (x, y)[index['tree_axis'][node]] - index['tree_split'][node]
+        near, far = (left, right) if diff < 0 else (right, left)
+        # the far side can only hold a closer point if the splitting line is closer than the k-th best so far
+        if len(best_points) < k or abs(diff) < best_distances.max():
+            stack.append(far)
+        stack.append(near)
+    order = np.argsort(best_distances)
+    return best_points[order], best_distances[order]
+
+def nearest(index, lat, lon, k = 1):
+    if not len(index['ids']):
+        return []
+    x, y = project(index, lat, lon)
+    points, distances = nearest_points(index, float(x), float(y), k)
+    return spatial_results(index, points, distances)
+
+def ring_nearest(index, x, y, k, ring):
+    # the k nearest points to each query among the points in the (2 ring + 1)^2 cells around it
+    cell_size = index['cell_size']
+    offsets = np.arange(-ring, ring + 1)
+    cx = np.floor(x / cell_size).astype(np.int64)
+    cy = np.floor(y / cell_size).astype(np.int64)
+    keys = (((cx[:, None, None] + offsets[None, :, None]) << 32) +
+            (cy[:, None, None] + offsets[None, None, :] + (1 << 31))).reshape(len(x), -1)
+    at = np.minimum(np.searchsorted(index['cell_keys'], keys), len(index['cell_keys']) - 1)
+    counts = np.where(index['cell_keys'][at] == keys, index['cell_counts'][at], 0).ravel()
+    starts = index['cell_starts'][at].ravel()
+    # one (query, point) pair for every point of every cell
+    query = np.repeat(np.repeat(np.arange(len(x)), keys.shape[1]), counts)
+    offset = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    points = index['grid_order'][np.repeat(starts, counts) + offset]
+    distances = np.hypot(index['x'][points] - x[query], index['y'][points] - y[query])
+    # the pairs are in query order already; sort by distance within each query with one float key
+    order = np.argsort(query + distances / (distances.max() * 2 + 1) if len(query) else query)
+    query, points, distances = query[order], points[order], distances[order]
+    rank = np.arange(len(query)) - np.searchsorted(query, np.arange(len(x)))[query]
+    best_points = np.full((len(x), k), -1, dtype=np.int64)
+    best_distances = np.full((len(x), k), np.inf)
+    keep = rank < k
+    best_points[query[keep], rank[keep]] = points[keep]
+    best_distances[query[keep], rank[keep]] = distances[keep]
+    return best_points, best_distances
+
+def nearest_batch(index, positions, k = 1, max_ring = 16, block_size = 20000):
+    # the k nearest points for each [lat, lon] in positions
+    if not len(index['ids']):
+        return [[] for pos in positions]
+    best_points, best_distances = nearest_batch_points(index, positions, k, max_ring, block_size)
+    return [spatial_results(index, points, distances) for points, distances in zip(best_points, best_distances)]
+
+def nearest_batch_points(index, positions, k = 1, max_ring = 16, block_size = 20000):
+    # the same as arrays: the positions of the k nearest points in the index for each query, and their distances
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+    xs, ys = project(index, positions[:, 0], positions[:, 1])
+    k = min(k, len(index['ids']))
+    best_points = np.full((len(xs), k), -1, dtype=np.int64)
+    best_distances = np.full((len(xs), k), np.inf)
+    for block in range(0, len(xs), block_size):
+        todo = np.arange(block, min(block + block_size, len(xs)))
+        ring = 1
+        while len(todo) and ring <= max_ring:
+            points, distances = ring_nearest(index, xs[todo], ys[todo], k, ring)
+            # nothing outside the searched cells is closer than ring cells
+            done = distances[:, k - 1] <= ring * index['cell_size']
+            best_points[todo[done]] = points[done]
+            best_distances[todo[done]] = distances[done]
+            todo = todo[~done]
+            ring *= 2
+        for i in todo:
+            best_points[i], best_distances[i] = nearest_points(index, xs[i], ys[i], k)
+    return best_points, best_distances
+
+# For example, the 3 nearest parking for every restaurant
+if __name__ == '__main__':
+    amenities = [el for el in shape_map(filename, geometry=True) if 'amenity' in el]
+    parking = build_spatial_index(el for el in amenities if el['amenity'] == 'parking')
+    restaurants = [el for el in amenities if el['amenity'] == 'restaurant' and (el.get('pos') or el.get('centroid'))]
+    nearby_parking = nearest_batch(parking, [el.get('pos') or el.get('centroid') for el in restaurants], k=3)
+    pprint.pprint(list(zip([el.get('name') for el in restaurants], nearby_parking))[:5])
+
+# ### Repairing cities and zip codes
+
+# For improvements 1 and 2, a first step can be automated:
+# 
+# 1. Fix the case of the city names with the table of the cities in the area in cleaning_rules.json.
+#    Cities not in the table are flagged.
+# 2. Count how often each zip code goes with each city. A city that is not the city most entries of its zip code
+#    agree on is flagged, and a missing city is filled in from its zip code.
+# 3. For the rest, let the nearest entries vote: a missing zip code or city is filled in when most of the nearby entries
+#    agree on one, and an entry is flagged when most of them agree on a different one.
+# 
+# The documents' fields are read once into numpy arrays, and all of the steps work on whole arrays,
+# so this takes seconds for millions of addresses. The filled in fields are listed in address['inferred'],
+# the suspicious ones in address['flagged'].
+
+# In[32]:
+
+city_table = dict((city.lower(), city) for city in cleaning_rules['cities'])
+city_table.update(cleaning_rules['city_aliases'])
+
+def first_postcode(postcode):
+    # update_zip_code gives a list of the 5 digit codes it found, or "" when there is none
+    if isinstance(postcode, list):
+        return postcode[0] if postcode else ''
+    return postcode or ''
+
+def address_records(docs):
+    records = {'docs': [], 'lat': [], 'lon': [], 'postcode': [], 'city': []}
+    for el in docs:
+        address = el.get('address')
+        pos = el.get('pos') or el.get('centroid')
+        if address and pos and None not in pos:
+            records['docs'].append(el)
+            records['lat'].append(pos[0])
+            records['lon'].append(pos[1])
+            records['postcode'].append(first_postcode(address.get('postcode')))
+            records['city'].append(address.get('city', ''))
+    for name in ['lat', 'lon']:
+        records[name] = np.array(records[name], dtype=np.float64)
+    for name in ['postcode', 'city']:
+        # the distinct values, and each record's number in them; 0 is the empty value
+        values, codes = np.unique(np.array([''] + records[name]), return_inverse=True)
+        records[name + '_values'] = values
+        records[name] = codes[1:]
+    return records
+
+def cooccurrence(rows, columns, n_rows, n_columns):
+    # how often each row value goes with each column value, leaving out the empty ones
+    both = (rows > 0) & (columns > 0)
+    counts = np.bincount(rows[both] * n_columns + columns[both], minlength=n_rows * n_columns)
+    return counts.reshape(n_rows, n_columns)
+
+def majority(matrix, min_share, min_count):
+    # the column most entries of each row agree on, or 0 when no column is clear enough
+    best = matrix.argmax(axis=1)
+    count = matrix[np.arange(len(matrix)), best]
+    total = matrix.sum(axis=1)
+    clear = (count >= min_count) & (count >= min_share * np.maximum(total, 1))
+    return np.where(clear, best, 0)
+
+def spatial_vote(records, labels, k, max_distance, min_share):
+    # the label most of the k nearest labelled records within max_distance agree on, for every record (0 for none)
+    labelled = np.nonzero(labels > 0)[0]
+    if not len(labelled):
+        return np.zeros(len(labels), dtype=np.int64)
+    index = build_point_index(labelled, labelled, records['lat'][labelled], records['lon'][labelled])
+    # one more neighbour than asked for, since a labelled record finds itself
+    points, distances = nearest_batch_points(index, np.column_stack([records['lat'], records['lon']]), k + 1)
+    neighbours = labelled[np.maximum(points, 0)]
+    votes = np.where((points >= 0) & (distances <= max_distance) &
+                     (neighbours != np.arange(len(labels))[:, None]), labels[neighbours], 0)
+    # count the votes for each neighbour's label among the row's votes
+    agree = ((votes[:, :, None] == votes[:, None, :]) & (votes[:, None, :] > 0)).sum(axis=2)
+    best = agree.argmax(axis=1)
+    winner = votes[np.arange(len(votes)), best]
+    share = agree[np.arange(len(votes)), best] / np.maximum((votes > 0).sum(axis=1), 1).astype(np.float64)
+    return np.where((winner > 0) & (share >= min_share), winner, 0)
+
+def repair_addresses(docs, k = 5, max_distance = 1000.0, min_share = 0.6, min_count = 3):
+    records = address_records(docs)
+    postcodes, cities = records['postcode'], records['city']
+    postcode_values = records['postcode_values']
+
+    # 1. the canonical names of the distinct cities, then of every record
+    canonical = np.array([city_table.get(city.strip().lower(), city) for city in records['city_values']])
+    known = np.array([city.strip().lower() in city_table for city in records['city_values']])
+    known[0] = True
+    city_values, city_codes = np.unique(canonical, return_inverse=True)
+    recased = (canonical != records['city_values'])[cities]
+    unknown = ~known[cities]
+    cities = city_codes[cities]
+
+    # 2. the zip code and city matrix; unknown cities do not count
+    counted = np.where(unknown, 0, cities)
+    matrix = cooccurrence(postcodes, counted, len(postcode_values), len(city_values))
+    postcode_city = majority(matrix, min_share, min_count)[postcodes]
+    city_from_postcode = (cities == 0) & (postcodes > 0) & (postcode_city > 0)
+    city_mismatch = (counted > 0) & (postcode_city > 0) & (counted != postcode_city)
+    cities = np.where(city_from_postcode, postcode_city, cities)
+
+    # 3. the nearby entries vote on the zip codes, and on the cities still missing
+    postcode_vote = spatial_vote(records, postcodes, k, max_distance, min_share)
+    postcode_filled = (postcodes == 0) & (postcode_vote > 0)
+    postcode_mismatch = (postcodes > 0) & (postcode_vote > 0) & (postcode_vote != postcodes)
+    city_vote = spatial_vote(records, np.where(unknown, 0, cities), k, max_distance, min_share)
+    city_filled = (cities == 0) & (city_vote > 0)
+    cities = np.where(city_filled, city_vote, cities)
+
+    # write the changes back to the documents that have any
+    changed = recased | unknown | city_from_postcode | city_mismatch | postcode_filled | postcode_mismatch | city_filled
+    for i in np.nonzero(changed)[0]:
+        address = records['docs'][i]['address']
+        if recased[i] or city_from_postcode[i] or city_filled[i]:
+            address['city'] = city_values[cities[i]].item()
+        if city_from_postcode[i] or city_filled[i]:
+            address.setdefault('inferred', []).append('city')
+        if postcode_filled[i]:
+            address['postcode'] = [postcode_values[postcode_vote[i]].item()]
+            address.setdefault('inferred', []).append('postcode')
+        if unknown[i] or city_mismatch[i]:
+            address.setdefault('flagged', []).append('city')
+        if postcode_mismatch[i]:
+            address.setdefault('flagged', []).append('postcode')
+
+    summary = {'addresses': len(records['docs']), 'cities recased': int(recased.sum()),
+               'unknown cities': int(unknown.sum()), 'cities from zip code': int(city_from_postcode.sum()),
+               'cities not matching zip code': int(city_mismatch.sum()), 'cities from neighbours': int(city_filled.sum()),
+               'zip codes from neighbours': int(postcode_filled.sum()),
+               'zip codes not matching neighbours': int(postcode_mismatch.sum())}
+    return summary, (postcode_values, city_values, matrix)
+
+if __name__ == '__main__':
+    addresses = [el for el in shape_map(filename, geometry=True) if 'address' in el]
+    summary, (zip_codes, city_names, zip_city_counts) = repair_addresses(addresses)
+    pprint.pprint(summary)
+
+
 # ### Conclusion
 
 # The dataset for the San Jose area is quite large. The user community who have contributed to the dataset is quite large too. This can be explained by the concentration of high tech companies and workforce in the area.
 # 
 # However, the dataset has many errors and many entries are incomplete. It interests me that some entries are of foreign languages or foreign places. Many immigrants, including users who want to contribute to the map could use some help from OpenStreetMap and the user community with familiarizing the area. It may help reduce errors and build a more robust dataset.
+
+# ## Keeping the collection up to date
+
+# OpenStreetMap publishes what changed every minute, hour and day as osmChange files (.osc, usually gzipped), which
+# list the elements created, modified and deleted. Downloading a new extract and loading it again costs the whole
+# region every time, so apply_changes runs just the changed nodes and ways through shape_record and the cleaning
+# rules, and applies them to the collection in batches of upserts and deletes, keyed by type and id.
+# 
+# * With relations, for a collection loaded with relations, the changed relations are shaped and applied too.
+# * With geometry, the ways that changed, and the ways of the nodes that moved or went away, get their geometry
+#   again from the nodes in the collection. With relations as well, so do the rings of the multipolygons and
+#   boundaries that changed, or that have one of those ways as a member.
+# * With the statistics of count_document (see the zip codes and cities above), the old version of each changed
+#   document is taken out of the counts and the new one put in, so the report stays that of the whole collection.
+#   Only exact counts can be taken back, so the statistics need a max_exact larger than the number of values.
+# 
+# The changes of a file are applied in order, so a diff that creates a node and then modifies it ends with the
+# modified node. To audit just the changed elements, run_audits and the other audits also read .osc files.
+
+# In[39]:
+
+import gzip
+from pymongo import ASCENDING, DeleteOne, IndexModel, ReplaceOne, UpdateOne
+
+change_indexes = [IndexModel([("type", ASCENDING), ("id", ASCENDING)])]
+# finding the ways of a node that moved
+way_node_index = IndexModel([("node_refs", ASCENDING)], sparse=True)
+way_geometry_fields = ['geometry', 'centroid', 'bbox', 'location']
+# finding the relations of a way that changed
+relation_member_index = IndexModel([("members.ref", ASCENDING)], sparse=True)
+relation_ring_fields = ['outer', 'inner', 'centroid', 'bbox', 'incomplete', 'location']
+
+def open_change_file(source):
+    name = source if isinstance(source, str) else getattr(source, 'name', '')
+    if isinstance(name, str) and name.endswith('.gz'):
+        return gzip.open(source, 'rb')
+    return open(source, 'rb') if isinstance(source, str) else source
+
+def change_records(source):
+    # (action, record) for each element of an osmChange file, in the order of the file
+    f = open_change_file(source)
+    try:
+        context = ET.iterparse(f, events=("start", "end"))
+        event, root = next(context)
+        action = None
+        depth = 0
+        for event, elem in context:
+            if event == "start":
+                depth += 1
+                if depth == 1:
+                    action = elem
+            else:
+                depth -= 1
+                if depth == 1:
+                    yield action.tag, element_record(elem)
+                    # the elements of an action are dropped as they are handed out
+                    action.clear()
+                elif depth == 0:
+                    root.clear()
+    finally:
+        if f is not source:
+            f.close()
+
+def changed_records(source):
+    # the records of the created and modified elements, after a root like the one of a map file
+    yield ('osmChange', {}, [], [], [])
+    for action, record in change_records(source):
+        if action != 'delete':
+            yield record
+
+def uncount_value(counter, value):
+    if isinstance(value, list):
+        value = tuple(value)
+    counts = counter['counts']
+    counts[value] -= 1
+    if not counts[value]:
+        del counts[value]
+
+def uncount_document(stats, el):
+    # take back count_document(stats, el)
+    if stats['users']['registers'] is not None or any(stats[name]['buckets'] is not None for name in
+            ['user counts', 'types', 'amenities', 'leisures', 'postcodes', 'cities']):
+        raise ValueError("approximate statistics cannot be updated, count them with a larger max_exact")
+    stats['documents'] -= 1
+    user = el.get('created', {}).get('user')
+    uncount_value(stats['user counts'], user)
+    if user is not None and user not in stats['user counts']['counts']:
+        stats['users']['values'].discard(user)
+    uncount_value(stats['types'], el['type'])
+    if 'amenity' in el:
+        uncount_value(stats['amenities'], el['amenity'])
+    if 'leisure' in el:
+        uncount_value(stats['leisures'], el['leisure'])
+    address = el.get('address', {})
+    if 'postcode' in address:
+        uncount_value(stats['postcodes'], address['postcode'])
+    if 'city' in address:
+        uncount_value(stats['cities'], address['city'])
+
+def update_way_geometry(collection, changes):
+    # the geometry of the changed ways, and of the ways of the changed nodes, from the nodes now in the collection
+    nodes = [record[1]['id'] for action, record in changes if record[0] == 'node']
+    ways = [record[1]['id'] for action, record in changes if record[0] == 'way' and action != 'delete']
+    query = {'type': 'way', '$or': [{'id': {'$in': ways}}, {'node_refs': {'$in': nodes}}]}
+    docs = list(collection.find(query, {'id': 1, 'node_refs': 1}))
+    if not docs:
+        return 0
+    refs = sorted(set(ref for doc in docs for ref in doc.get('node_refs', [])))
+    store = node_store()
+    for node in collection.find({'type': 'node', 'id': {'$in': refs}}, {'id': 1, 'pos': 1}):
+        if None not in node.get('pos', [None]):
+            add_node(store, node['id'], node['pos'][0], node['pos'][1])
+    finalize_nodes(store)
+    operations = []
+    for way in add_geometry(store, docs):
+        if 'geometry' in way:
+            add_location(way)
+            update = {'$set': dict((field, way[field]) for field in way_geometry_fields)}
+        else:
+            update = {'$unset': dict((field, "") for field in way_geometry_fields)}
+        operations.append(UpdateOne({'_id': way['_id']}, update))
+    collection.bulk_write(operations, ordered=False)
+    return len(operations)
+
+def update_relation_rings(collection, changes):
+    # the rings of the changed relations, and of the relations of the changed ways and of the ways of the changed
+    # nodes, from the ways and nodes now in the collection
+    nodes = [record[1]['id'] for action, record in changes if record[0] == 'node']
+    ways = [record[1]['id'] for action, record in changes if record[0] == 'way']
+    if nodes:
+        ways += [doc['id'] for doc in collection.find({'type': 'way', 'node_refs': {'$in': nodes}}, {'id': 1})]
+    relations = [record[1]['id'] for action, record in changes if record[0] == 'relation' and action != 'delete']
+    query = {'type': 'relation', 'relation_type': {'$in': ring_relation_types},
+             '$or': [{'id': {'$in': relations}}, {'members': {'$elemMatch': {'type': 'way', 'ref': {'$in': ways}}}}]}
+    docs = list(collection.find(query, {'members': 1}))
+    if not docs:
+        return 0
+    member_ways = sorted(set(m['ref'] for doc in docs for m in doc.get('members', []) if m['type'] == 'way'))
+    way_index = way_store()
+    refs = set()
+    for way in collection.find({'type': 'way', 'id': {'$in': member_ways}}, {'id': 1, 'node_refs': 1}):
+        add_way(way_index, way['id'], way.get('node_refs', []))
+        refs.update(way.get('node_refs', []))
+    finalize_ways(way_index)
+    store = node_store()
+    for node in collection.find({'type': 'node', 'id': {'$in': sorted(refs)}}, {'id': 1, 'pos': 1}):
+        if None not in node.get('pos', [None]):
+            add_node(store, node['id'], node['pos'][0], node['pos'][1])
+    finalize_nodes(store)
+    operations = []
+    for doc in docs:
+        relation = add_location(add_rings(store, way_index, {'members': doc.get('members', [])}))
+        update = {'$set': dict((field, relation[field]) for field in relation_ring_fields if field in relation)}
+        missing = [field for field in relation_ring_fields if field not in relation]
+        if missing:
+            update['$unset'] = dict((field, "") for field in missing)
+        operations.append(UpdateOne({'_id': doc['_id']}, update))
+    collection.bulk_write(operations, ordered=False)
+    return len(operations)
+
+def apply_change_batch(collection, changes, stats, geometry, summary, relations = False):
+    keys = [(record[0], record[1]['id']) for action, record in changes]
+    # the documents as they are before the changes, to take them out of the statistics
+    current = {}
+    if stats is not None:
+        for kind in ['node', 'way'] + (['relation'] if relations else []):
+            ids = [element_id for element_type, element_id in keys if element_type == kind]
+            if ids:
+                for doc in collection.find({'type': kind, 'id': {'$in': ids}}, {'_id': 0}):
+                    current[(kind, doc['id'])] = doc
+    operations = []
+    for (action, record), key in zip(changes, keys):
+        doc = None if action == 'delete' else shape_record(record, relations)
+        if stats is not None:
+            if current.get(key) is not None:
+                uncount_document(stats, current[key])
+            if doc is not None:
+                count_document(stats, doc)
+            current[key] = doc
+        selector = {'type': key[0], 'id': key[1]}
+        if doc is None:
+            operations.append(DeleteOne(selector))
+        else:
+            operations.append(ReplaceOne(selector, add_location(doc), upsert=True))
+        summary["{0} {1}".format(action, key[0])] += 1
+    collection.bulk_write(operations, ordered=True)
+    if geometry:
+        summary['way geometry'] += update_way_geometry(collection, changes)
+        if relations:
+            summary['relation rings'] += update_relation_rings(collection, changes)
+
+def apply_changes(change_file, collection, stats = None, geometry = False, batch_size = 1000, relations = False):
+    # collection was loaded by load_map, with the same geometry and relations, and stats counted from the same
+    # documents
+    indexes = change_indexes + ([way_node_index] if geometry else [])
+    if geometry and relations:
+        indexes.append(relation_member_index)
+    collection.create_indexes(indexes)
+    summary = Counter()
+    changes = []
+    rule_hits.clear()
+    for action, record in change_records(change_file):
+        # without relations, the collection has none to change
+        if record[0] not in ['node', 'way'] + (['relation'] if relations else []):
+            summary["{0} {1}".format(action, record[0])] += 1
+            continue
+        changes.append((action, record))
+        if len(changes) == batch_size:
+            apply_change_batch(collection, changes, stats, geometry, summary, relations)
+            changes = []
+    if changes:
+        apply_change_batch(collection, changes, stats, geometry, summary, relations)
+    bump_collection_version(collection)
+    report_rule_hits()
+    return dict(summary)
+
+# For example, apply a day of changes to the collection, keeping the statistics up to date.
+# Download a diff of the area to change_file first; without one, this is skipped.
+change_file = 'san-jose_california.osc.gz'
+
+if __name__ == '__main__' and os.path.exists(change_file):
+    stats = new_report_stats(max_exact = 1 << 30)
+    for el in san_jose.find({}, {'_id': 0}):
+        count_document(stats, el)
+    pprint.pprint(apply_changes(change_file, san_jose, stats))
+    pprint.pprint(report_stats(stats))
+
+
+# ## Running many regions
+
+# The same wrangling is run for dozens of metro extracts, and running them one after another leaves most of the
+# cores idle. run_batch takes a manifest, a json list of regions such as
+# 
+#     {"name": "san-jose", "file": "san-jose_california.osm", "steps": ["audit", "convert", "load"],
+#      "cpus": 4, "memory": 2048, "collection": "sanjose", "region": null}
+# 
+# and runs each region's steps in a process of its own, as many at once as their budgets allow: the cpus of the jobs
+# running add up to at most the cores of the box, and their memory (in MB) to at most its memory. The biggest files
+# start first, so the small ones fill the gaps at the end. A job that needs more than its memory fails instead of
+# taking the box down, and a failed job is tried again, up to retries times. The conversion of a whole file on one cpu
+# goes on from its checkpoint when the job died (see process_map_resumable above); with more cpus, or a region,
+# it starts over, as process_map_parallel and the regions save no checkpoints.
+# 
+# The jobs are forked from this process, so they share the compiled cleaning rules and street fixes without
+# compiling or copying them. Each finished job also hands back the street names it normalized, so the jobs started
+# after it begin with a warmer cache. The audit results are shared through the cache on disk.
+# 
+# The summary has, for each region, how it ended, how many attempts it took, and the seconds of each step.
+
+# In[43]:
+
+import multiprocessing.connection
+
+batch_defaults = {'steps': ['audit', 'convert', 'load'], 'cpus': 1, 'memory': 1024, 'region': None}
+
+def audit_job(job, db_uri):
+    results = run_audits(job['file'], job['region'])
+    street_types = audit(job['file'], street_type_re, expected_names, job['region'])
+    return {'tags': results['tags'], 'users': len(results['users']), 'unexpected street types': len(street_types)}
+
+def convert_job(job, db_uri):
+    if job['region'] is not None:
+        return sum(1 for el in stream_map(job['file'], region=job['region']))
+    if job['cpus'] > 1:
+        return process_map_parallel(job['file'], processes=job['cpus'])
+    return process_map_resumable(job['file'], resume=True)
+
+def load_job(job, db_uri):
+    # a retry loads the collection again from the start
+    collection = MongoClient(db_uri)[db_name][job['collection']]
+    collection.drop()
+    return load_map(job['file'], collection, region=job['region'])
+
+batch_steps = OrderedDict([('audit', audit_job), ('convert', convert_job), ('load', load_job)])
+
+def load_manifest(manifest):
+    # the jobs of a manifest file, or of a list of regions, with the defaults filled in
+    if isinstance(manifest, str):
+        with open(manifest) as f:
+            manifest = json.load(f)
+    jobs = []
+    for region in manifest:
+        job = dict(batch_defaults, **region)
+        job.setdefault('collection', job['name'])
+        unknown = [step for step in job['steps'] if step not in batch_steps]
+        if unknown:
+            raise ValueError("{0} has unknown steps {1}".format(job['name'], unknown))
+        jobs.append(job)
+    return jobs
+
+def box_memory():
+    # the memory of the box in MB, or None where the system does not tell
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // (1 << 20)
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def limit_memory(megabytes):
+    # on top of what the process has mapped already, most of it shared with the parent
+    if resource is None:
+        return
+    try:
+        with open('/proc/self/statm') as f:
+            mapped = int(f.read().split()[0]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        mapped = 0
+    soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+    limit = mapped + megabytes * (1 << 20)
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+
+def run_job(job, conn, db_uri):
+    # the forked process of one attempt at a job
+    result = {'name': job['name'], 'seconds': OrderedDict(), 'results': {}}
+    try:
+        limit_memory(job['memory'])
+        for step in job['steps']:
+            start = time.time()
+            result['results'][step] = batch_steps[step](job, db_uri)
+            result['seconds'][step] = time.time() - start
+        result['status'] = 'done'
+    except BaseException as e:
+        result['status'] = 'failed'
+        result['error'] = "{0}: {1}".format(type(e).__name__, e)
+    result['street cache'] = list(street_cache.items())
+    conn.send(result)
+    conn.close()
+
+def run_batch(manifest, cpus = None, memory = None, retries = 2, db_uri = 'localhost:27017'):
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        raise ValueError("run_batch shares the cleaning state with forked processes, which this system does not have")
+    context = multiprocessing.get_context('fork')
+    cpus = cpus or multiprocessing.cpu_count()
+    memory = memory or box_memory()
+    jobs = load_manifest(manifest)
+    for job in jobs:
+        if job['cpus'] > cpus or (memory is not None and job['memory'] > memory):
+            raise ValueError("{0} needs more than the box has".format(job['name']))
+    pending = sorted(jobs, key=lambda job: os.path.getsize(job['file']) if os.path.exists(job['file']) else 0,
+                     reverse=True)
+    attempts = Counter()
+    running = {}
+    summary = OrderedDict((job['name'], None) for job in jobs)
+    start = time.time()
+    busy = 0.0
+    while pending or running:
+        # start every job that fits in what the running ones leave
+        used_cpus = sum(job['cpus'] for job, process, started in running.values())
+        used_memory = sum(job['memory'] for job, process, started in running.values())
+        for job in list(pending):
+            if used_cpus + job['cpus'] > cpus or (memory is not None and used_memory + job['memory'] > memory):
+                continue
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(target=run_job, args=(job, sender, db_uri))
+            process.start()
+            sender.close()
+            attempts[job['name']] += 1
+            running[receiver] = (job, process, time.time())
+            pending.remove(job)
+            used_cpus += job['cpus']
+            used_memory += job['memory']
+        # the result comes down the pipe, or the pipe closes when the process dies without one
+        for receiver in multiprocessing.connection.wait(list(running)):
+            job, process, started = running.pop(receiver)
+            try:
+                result = receiver.recv()
+            except EOFError:
+                result = {'name': job['name'], 'status': 'failed', 'seconds': {}, 'results': {}}
+            receiver.close()
+            process.join()
+            if result['status'] != 'done' and 'error' not in result:
+                result['error'] = "the process exited with {0}".format(process.exitcode)
+            busy += job['cpus'] * (time.time() - started)
+            for name, new_name in result.pop('street cache', []):
+                street_cache[name] = new_name
+            while len(street_cache) > street_cache_size:
+                street_cache.popitem(last=False)
+            result['attempts'] = attempts[job['name']]
+            result['total seconds'] = sum(result['seconds'].values())
+            summary[job['name']] = result
+            if result['status'] != 'done' and attempts[job['name']] <= retries:
+                pending.append(job)
+    seconds = time.time() - start
+    report = {'regions': summary, 'seconds': seconds,
+              'failed': [name for name, result in summary.items() if result['status'] != 'done'],
+              'utilization': busy / (seconds * cpus) if seconds else 0.0}
+    pprint.pprint(dict((name, (result['status'], result['attempts'], dict(result['seconds'])))
+                       for name, result in summary.items()))
+    return report
+
+# For example, run every region of the manifest; write one to manifest_file first, without one this is skipped
+manifest_file = 'regions.json'
+
+if __name__ == '__main__' and os.path.exists(manifest_file):
+    report = run_batch(manifest_file)
+    pprint.pprint(report['failed'])
+
+
+# ## Benchmarks
+
+# The San Jose file is too big to keep around just to time the code, so generate_map writes a synthetic map of about
+# any size, from a megabyte to many gigabytes, always the same for the same size and seed. It has what makes the real
+# one slow and messy:
+# 
+# * about 8 untagged nodes on a street for every node with tags, and a way for each street or building,
+# * amenities, leisures and addresses in about the proportions of the San Jose file,
+# * abbreviated street types and directions, the street names of cleaning_rules.json, postcodes like "CA 95014" or
+#   "95014-1234", city names in any case, and a few tag keys with colons or problem characters,
+# * a few users making most of the edits.
+# 
+# The layout of the nodes (which ones are points of interest, streets or buildings) comes from its own random
+# generator, which is run again to write the ways, so nothing about the nodes has to be kept in memory.
+
+# In[33]:
+
+import random
+from xml.sax.saxutils import quoteattr
+
+synthetic_cities = [("San Jose", 37.3382, -121.8863, ["95110", "95112", "95125", "95126", "95128"]),
+                    ("Sunnyvale", 37.3688, -122.0363, ["94085", "94086", "94087"]),
+                    ("Santa Clara", 37.3541, -121.9552, ["95050", "95051", "95054"]),
+                    ("Cupertino", 37.3230, -122.0322, ["95014"]),
+                    ("Mountain View", 37.3861, -122.0839, ["94040", "94041", "94043"]),
+                    ("Campbell", 37.2872, -121.9500, ["95008"]),
+                    ("Milpitas", 37.4323, -121.8996, ["95035"])]
+synthetic_streets = ["Stevens Creek", "Homestead", "Bascom", "Winchester", "Saratoga", "Zanker", "Evelyn", "1st",
+                     "Hamilton", "Lincoln", "Blossom Hill", "Capitol", "Tully", "Story", "Meridian", "Almaden",
+                     "Mathilda", "De Anza", "Lawrence", "Bollinger", "Calle de Barcelona", "Via San Marino"]
+synthetic_types = [("Street", 30), ("St", 8), ("St.", 2), ("Avenue", 25), ("Ave", 8), ("ave", 1), ("Boulevard", 6),
+                   ("Blvd", 3), ("Blvd.", 1), ("Road", 10), ("Rd", 4), ("Drive", 10), ("Dr", 3), ("Court", 5),
+                   ("Ct", 2), ("Lane", 3), ("Ln", 1), ("Way", 5), ("Loop", 1), ("Real", 1)]
+synthetic_directions = [("", 70), ("N ", 5), ("N. ", 1), ("S ", 5), ("E ", 4), ("W ", 4), ("North ", 4),
+                        ("South ", 3), ("East ", 2), ("West ", 2)]
+synthetic_amenities = [("parking", 30), ("restaurant", 15), ("school", 8), ("place_of_worship", 7), ("fast_food", 7),
+                       ("cafe", 5), ("bench", 5), ("fuel", 4), ("bank", 4), ("toilets", 3), ("post_box", 3),
+                       ("pharmacy", 2), ("library", 1)]
+synthetic_leisures = [("pitch", 35), ("park", 30), ("playground", 20), ("swimming_pool", 10), ("garden", 5)]
+synthetic_highways = [("residential", 60), ("service", 20), ("tertiary", 8), ("secondary", 6), ("primary", 4),
+                      ("footway", 2)]
+synthetic_extra_tags = [("source", "survey"), ("tiger:county", "Santa Clara, CA"), ("name:en", "Main"),
+                        ("FIXME", "check the name"), ("fixme?", "position"), ("note 2", "gate"),
+                        ("gnis:feature_id", "1654997"), ("is_in:state_code", "CA")]
+
+def weighted(rng, choices):
+    # one of the (value, weight) choices
+    total = sum(weight for value, weight in choices)
+    pick = rng.random() * total
+    for value, weight in choices:
+        pick -= weight
+        if pick < 0:
+            return value
+    return choices[-1][0]
+
+def synthetic_street(rng):
+    street = rng.random()
+    if street < 0.02:
+        return rng.choice(cleaning_rules['drop'])
+    if street < 0.04:
+        return rng.choice(sorted(cleaning_rules['overrides']))
+    name = (weighted(rng, synthetic_directions) + rng.choice(synthetic_streets) + " " +
+            weighted(rng, synthetic_types))
+    if street < 0.05:
+        return "{0} Suite #{1}".format(name, rng.randint(1, 300))
+    if street < 0.06:
+        return "{0}, {1}, CA".format(name, rng.choice(synthetic_cities)[0])
+    if street < 0.07:
+        return "{0} {1}".format(rng.randint(1, 9999), name)
+    return name
+
+def synthetic_postcode(rng, city):
+    postcode = rng.choice(city[3])
+    messy = rng.random()
+    if messy < 0.05:
+        return "CA " + postcode
+    if messy < 0.08:
+        return "{0}-{1:04d}".format(postcode, rng.randint(0, 9999))
+    if messy < 0.09:
+        return postcode[:4]
+    return postcode
+
+def synthetic_city(rng, city):
+    name = city[0]
+    messy = rng.random()
+    if messy < 0.1:
+        return name.lower()
+    if messy < 0.15:
+        return name.upper()
+    if messy < 0.17:
+        return "Kayseri"
+    return name
+
+def synthetic_address(rng, city):
+    tags = [("addr:housenumber", str(rng.randint(1, 9999))), ("addr:street", synthetic_street(rng))]
+    if rng.random() < 0.7:
+        tags.append(("addr:postcode", synthetic_postcode(rng, city)))
+    if rng.random() < 0.4:
+        tags.append(("addr:city", synthetic_city(rng, city)))
+    if rng.random() < 0.1:
+        tags.append(("addr:state", "CA"))
+    return tags
+
+def synthetic_info(rng, users):
+    # a few users make most of the edits
+    uid = min(int(rng.paretovariate(0.8)), users)
+    return ('visible="true" version="{0}" changeset="{1}" timestamp="{2}" user="user{3}" uid="{3}"'.format(
+        rng.randint(1, 9), rng.randint(1, 50000000),
+        time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(1199145600 + rng.randint(0, 300000000))), uid))
+
+def synthetic_tags(tags):
+    return ['    <tag k={0} v={1}/>\n'.format(quoteattr(k), quoteattr(v)) for k, v in tags]
+
+def synthetic_layout(seed):
+    # the kind and number of nodes of each group of nodes: a point of interest, a street or a building
+    rng = random.Random(seed)
+    while True:
+        kind = rng.random()
+        if kind < 0.4:
+            yield 'poi', 1
+        elif kind < 0.75:
+            yield 'street', rng.randint(2, 25)
+        else:
+            yield 'building', 4
+
+def synthetic_nodes(rng, kind, count, first_id, users):
+    city = rng.choice(synthetic_cities)
+    lat = rng.gauss(city[1], 0.03)
+    lon = rng.gauss(city[2], 0.03)
+    step = (rng.uniform(-0.0006, 0.0006), rng.uniform(-0.0006, 0.0006))
+    lines = []
+    for i in range(count):
+        if kind == 'building':
+            # the corners of a small square
+            point = (lat + 0.0002 * (i in (1, 2)), lon + 0.0002 * (i in (2, 3)))
+        else:
+            point = (lat + step[0] * i, lon + step[1] * i)
+        tags = []
+        if kind == 'poi':
+            if rng.random() < 0.75:
+                tags.append(("amenity", weighted(rng, synthetic_amenities)))
+            else:
+                tags.append(("leisure", weighted(rng, synthetic_leisures)))
+            if rng.random() < 0.6:
+                tags.append(("name", "{0} {1}".format(rng.choice(synthetic_streets), tags[0][1].title())))
+            if rng.random() < 0.5:
+                tags.extend(synthetic_address(rng, city))
+            if rng.random() < 0.15:
+                tags.append(rng.choice(synthetic_extra_tags))
+        head = '  <node id="{0}" {1} lat="{2:.7f}" lon="{3:.7f}"'.format(first_id + i, synthetic_info(rng, users),
+                                                                         point[0], point[1])
+        if tags:
+            lines.append(head + '>\n')
+            lines.extend(synthetic_tags(tags))
+            lines.append('  </node>\n')
+        else:
+            lines.append(head + '/>\n')
+    return lines
+
+def synthetic_way(rng, kind, refs, way_id, users):
+    tags = []
+    if kind == 'building':
+        refs = refs + refs[:1]
+        tags.append(("building", "yes"))
+        if rng.random() < 0.5:
+            tags.extend(synthetic_address(rng, rng.choice(synthetic_cities)))
+    else:
+        tags.append(("highway", weighted(rng, synthetic_highways)))
+        tags.append(("name", synthetic_street(rng)))
+        if rng.random() < 0.2:
+            tags.append(rng.choice(synthetic_extra_tags))
+    lines = ['  <way id="{0}" {1}>\n'.format(way_id, synthetic_info(rng, users))]
+    lines.extend(['    <nd ref="{0}"/>\n'.format(ref) for ref in refs])
+    lines.extend(synthetic_tags(tags))
+    lines.append('  </way>\n')
+    return lines
+
+def synthetic_relation(rng, relation_id, ways, users):
+    lines = ['  <relation id="{0}" {1}>\n'.format(relation_id, synthetic_info(rng, users))]
+    if rng.random() < 0.5:
+        tags = [("type", "multipolygon"), ("building", "yes")]
+        roles = ["outer"] + ["inner"] * rng.randint(0, 2)
+    else:
+        tags = [("type", "route"), ("route", "bus"), ("ref", str(rng.randint(10, 99)))]
+        roles = [""] * rng.randint(2, 6)
+    for role in roles:
+        lines.append('    <member type="way" ref="{0}" role="{1}"/>\n'.format(rng.randint(1, max(ways, 1)), role))
+    lines.extend(synthetic_tags(tags))
+    lines.append('  </relation>\n')
+    return lines
+
+def generate_map(file_out, size, seed = 0, users = 1500, relation_share = 0.002):
+    # an osm xml file of about size bytes: the nodes and, after them, the ways of the nodes, until there is only
+    # relation_share of size left, then relations for the rest.
+    # The ways are generated once while writing the nodes, just to know how long they are, and again with a copy
+    # of the same random generator to write them.
+    rng = random.Random(seed)
+    way_rng = random.Random(seed + 1)
+    with open(file_out, 'wb') as f:
+        written = 0
+        header = ('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6" generator="generate_map">\n'
+                  ' <bounds minlat="37.1" minlon="-122.2" maxlat="37.6" maxlon="-121.6"/>\n')
+        f.write(header.encode('utf-8'))
+        written += len(header)
+        way_bytes = 0
+        groups = 0
+        ways = 0
+        node_id = 1
+        lines = []
+        for kind, count in synthetic_layout(seed):
+            nodes = ''.join(synthetic_nodes(rng, kind, count, node_id, users))
+            lines.append(nodes)
+            written += len(nodes)
+            if kind != 'poi':
+                ways += 1
+                way_bytes += len(''.join(synthetic_way(way_rng, kind, list(range(node_id, node_id + count)), ways,
+                                                       users)))
+            node_id += count
+            groups += 1
+            if len(lines) == 1000:
+                f.write(''.join(lines).encode('utf-8'))
+                lines = []
+            if written + way_bytes >= (1 - relation_share) * size:
+                break
+        f.write(''.join(lines).encode('utf-8'))
+
+        way_rng = random.Random(seed + 1)
+        ways = 0
+        node_id = 1
+        lines = []
+        for group, (kind, count) in zip(range(groups), synthetic_layout(seed)):
+            if kind != 'poi':
+                ways += 1
+                lines.extend(synthetic_way(way_rng, kind, list(range(node_id, node_id + count)), ways, users))
+            node_id += count
+            if len(lines) > 10000:
+                f.write(''.join(lines).encode('utf-8'))
+                lines = []
+        f.write(''.join(lines).encode('utf-8'))
+        written += way_bytes
+
+        relations = 0
+        lines = []
+        while not relations or written < size - 10:
+            relations += 1
+            relation = ''.join(synthetic_relation(rng, relations, ways, users))
+            lines.append(relation)
+            written += len(relation)
+        lines.append('</osm>\n')
+        f.write(''.join(lines).encode('utf-8'))
+    return {'bytes': os.path.getsize(file_out), 'nodes': node_id - 1, 'ways': ways, 'relations': relations}
+
+if __name__ == '__main__':
+    pprint.pprint(generate_map('synthetic.osm', 10 << 20))
+
+
+# Each stage of the conversion is timed on its own, in a pass over the whole file. The passes all parse the file,
+# so a stage's own time is its pass minus the pass it builds on; for shape_element, for example, the parse alone.
+# Every pass runs once more under tracemalloc for its peak memory.
+# The results are saved as json, and compared with a baseline measured on the same synthetic map:
+# a stage that got more than threshold slower, or bigger, than in the baseline is a regression.
+
+# In[34]:
+
+import platform
+import tracemalloc
+
+benchmark_stages = []
+
+def register_benchmark(name, run, base = None):
+    # run(file_in) makes one pass over the file
+    benchmark_stages.append((name, run, base))
+
+def visitor_pass(visitor, initial):
+    def run(file_in):
+        result = copy.deepcopy(initial)
+        for element in iter_map(file_in):
+            result = visitor(element, result)
+        return result
+    return run
+
+def street_audit_pass(file_in):
+    return_list = defaultdict(set)
+    for street_name in visitor_pass(tag_value_collector("addr:street"), set())(file_in):
+        audit_street_type(return_list, street_name, street_type_re, expected_names)
+    return return_list
+
+register_benchmark('parse', lambda file_in: deque(iter_records(file_in), maxlen=0))
+register_benchmark('elements', lambda file_in: deque(iter_map(file_in), maxlen=0), 'parse')
+register_benchmark('tag audit', visitor_pass(count_tags, {}), 'elements')
+register_benchmark('key_type', visitor_pass(key_type, {"lower": 0, "lower_colon": 0, "problemchars": 0, "other": 0}),
+                   'elements')
+register_benchmark('audit', street_audit_pass, 'elements')
+register_benchmark('shape_element', lambda file_in: deque(shape_map(file_in), maxlen=0), 'parse')
+register_benchmark('json', lambda file_in: deque((to_json_line(el) for el in shape_map(file_in)), maxlen=0),
+                   'shape_element')
+# keeping all the documents, as dictionaries or as compact records; compare their peak memory
+register_benchmark('documents', lambda file_in: list(shape_map(file_in)), 'shape_element')
+register_benchmark('compact records', lambda file_in: compact_map(file_in), 'shape_element')
+
+def load_pass(collection):
+    def run(file_in):
+        collection.drop()
+        return load_map(file_in, collection, indexes=False)
+    return run
+
+def backend_name():
+    return next(name for name, backend in xml_backends.items() if backend is pick_backend())
+
+def run_benchmarks(file_in, memory = True, repeat = 1):
+    size = os.path.getsize(file_in)
+    results = {'file': file_in, 'bytes': size, 'python': platform.python_version(), 'xml backend': backend_name(),
+               'stages': OrderedDict()}
+    for name, run, base in benchmark_stages:
+        timings = []
+        for i in range(repeat):
+            start = time.time()
+            run(file_in)
+            timings.append(time.time() - start)
+        stage = {'seconds': min(timings)}
+        stage['stage seconds'] = max(stage['seconds'] - results['stages'][base]['seconds'], 0.0) if base else \
+            stage['seconds']
+        stage['MB per second'] = size / 1e6 / stage['seconds'] if stage['seconds'] else 0
+        if memory:
+            tracemalloc.start()
+            try:
+                run(file_in)
+                stage['peak memory'] = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+        results['stages'][name] = stage
+    return results
+
+def save_benchmarks(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+
+def load_benchmarks(path):
+    with open(path) as f:
+        return json.load(f, object_pairs_hook=OrderedDict)
+
+def compare_benchmarks(results, baseline, threshold = 0.25, min_seconds = 0.05):
+    # the stages that got slower or bigger than the baseline by more than threshold;
+    # stage times that moved by less than min_seconds are left out as noise
+    if results['bytes'] != baseline['bytes']:
+        raise ValueError("the baseline was measured on a different file")
+    regressions = {}
+    for name, stage in results['stages'].items():
+        old = baseline['stages'].get(name)
+        if old is None:
+            continue
+        for measure in ['stage seconds', 'peak memory']:
+            if measure not in stage or measure not in old:
+                continue
+            if measure == 'stage seconds' and stage[measure] - old[measure] < min_seconds:
+                continue
+            if stage[measure] > old[measure] * (1 + threshold):
+                regressions[name + ': ' + measure] = {'baseline': old[measure], 'now': stage[measure]}
+    return regressions
+
+# time the stages on the synthetic map, loading it too, and check them against the baseline
+if __name__ == '__main__':
+    register_benchmark('load', load_pass(db['benchmark']), 'shape_element')
+    results = run_benchmarks('synthetic.osm')
+    db['benchmark'].drop()
+    pprint.pprint(results)
+    save_benchmarks(results, 'benchmark_results.json')
+    if os.path.exists('benchmark_baseline.json'):
+        regressions = compare_benchmarks(results, load_benchmarks('benchmark_baseline.json'))
+        pprint.pprint(regressions)
+        if regressions:
+            raise RuntimeError("the conversion got slower or bigger than the baseline: {0}".format(
+                ", ".join(sorted(regressions))))
+    else:
+        save_benchmarks(results, 'benchmark_baseline.json')
@@ -0,0 +1,528 @@
+# Tests for WrangleOpenStreetMapData.py, run with pytest from this directory.
+#
+# The script is a notebook export, so it is not imported: its cells are run one by one into a module,
+# in a directory of its own, with a tiny map in place of the San Jose extract. The cells that query
+# the MongoDB collection are left out, so no server is needed.
+
+import ast
+import calendar
+import copy
+import gzip
+import inspect
+import os
+import shutil
+import struct
+import sys
+import time
+import tracemalloc
+import types
+import zlib
+from collections import deque
+from decimal import Decimal
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('pymongo')
+
+# with this set to some GB, the peak memory of the streaming conversion is also checked on a map that big
+big_map_bytes = int(os.environ.get('WRANGLE_BIG_MAP_BYTES', 0))
+
+here = os.path.dirname(os.path.abspath(__file__))
+script = os.path.join(here, 'WrangleOpenStreetMapData.py')
+
+sample_map = '''<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6" generator="test">
+ <node id="1" visible="true" version="2" changeset="10" timestamp="2015-03-01T10:00:00Z" user="a" uid="1"
+       lat="37.3382000" lon="-121.8863000">
+  <tag k="addr:street" v="N 1st St"/>
+  <tag k="addr:postcode" v="95110"/>
+ </node>
+ <node id="2" visible="true" version="1" changeset="11" timestamp="2015-03-02T10:00:00Z" user="b" uid="2"
+       lat="37.3390000" lon="-121.8870000"/>
+ <way id="3" visible="true" version="1" changeset="12" timestamp="2015-03-03T10:00:00Z" user="a" uid="1">
+  <nd ref="1"/>
+  <nd ref="2"/>
+  <tag k="highway" v="residential"/>
+  <tag k="name" v="Stevens Creek Blvd"/>
+ </way>
+</osm>
+'''
+
+def needs_server(source):
+    # the cells that query the collection, or read the json file mongoimport was run on
+    return 'san_jose.' in source or 'file_size' in source
+
+@pytest.fixture(scope='session')
+def wrangle(tmp_path_factory):
+    work = tmp_path_factory.mktemp('wrangle')
+    shutil.copy(os.path.join(here, 'cleaning_rules.json'), str(work))
+    with open(str(work / 'san-jose_california.osm'), 'w') as f:
+        f.write(sample_map)
+    cwd = os.getcwd()
+    os.chdir(str(work))
+    # registered, so that the worker processes can find the functions they are sent
+    module = types.ModuleType('wrangle')
+    module.__file__ = script
+    sys.modules['wrangle'] = module
+    try:
+        with open(script) as f:
+            source = f.read()
+        lines = source.split('\n')
+        for statement in ast.parse(source).body:
+            if not needs_server('\n'.join(lines[statement.lineno - 1:statement.end_lineno])):
+                exec(compile(ast.Module([statement], []), script, 'exec'), module.__dict__)
+        yield module
+    finally:
+        os.chdir(cwd)
+        del sys.modules['wrangle']
+
+@pytest.fixture(scope='session')
+def small_map(wrangle, tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('maps') / 'small.osm')
+    wrangle.generate_map(path, 1 << 20, seed=1, relation_share=0.02)
+    return path
+
+def without_sort(method):
+    def add(self, *args, sort = None, **kwargs):
+        return method(self, *args, **kwargs)
+    return add
+
+@pytest.fixture
+def collection(monkeypatch):
+    # an in-process stand-in for the MongoDB collection
+    mongomock = pytest.importorskip('mongomock')
+    # newer pymongo hands the replacements and updates of bulk_write a sort, which mongomock may not take
+    builder = mongomock.collection.BulkOperationBuilder
+    for name in ['add_replace', 'add_update']:
+        method = getattr(builder, name)
+        if 'sort' not in inspect.signature(method).parameters:
+            monkeypatch.setattr(builder, name, without_sort(method))
+    return mongomock.MongoClient().osm.sanjose
+
+
+def read_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def peak_memory(function, *args):
+    tracemalloc.start()
+    try:
+        function(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def test_streaming_memory_is_flat(wrangle, tmp_path):
+    # a scaled-down stand-in for the bound on a multi-GB map below: the Python heap traced while converting
+    # 6 MB stays that of converting 2 MB. The base map is a few of the parser's blocks, so the bigger one only
+    # adds more of the same.
+    base_map, bigger_map = str(tmp_path / 'base.osm'), str(tmp_path / 'bigger.osm')
+    wrangle.generate_map(base_map, 2 << 20, seed=2)
+    wrangle.generate_map(bigger_map, 6 << 20, seed=3)
+    convert = lambda file_in: deque(wrangle.stream_map(file_in), maxlen=0)
+    base = peak_memory(convert, base_map)
+    assert peak_memory(convert, bigger_map) < base * 1.25
+
+@pytest.mark.skipif(not big_map_bytes, reason="set WRANGLE_BIG_MAP_BYTES to convert a map that big")
+def test_streaming_peak_rss(wrangle, tmp_path):
+    big_map = str(tmp_path / 'big.osm')
+    wrangle.generate_map(big_map, big_map_bytes, seed=3)
+    before = wrangle.current_rss()
+    # the metrics keep the largest resident memory seen
+    wrangle.start_metrics(interval=0.1)
+    try:
+        deque(wrangle.stream_map(big_map), maxlen=0)
+    finally:
+        report = wrangle.stop_metrics()
+    assert report['peak rss'] - before < 256 << 20
+
+def test_conversions_write_the_same_file(wrangle, small_map):
+    file_out = small_map + '.json'
+    wrangle.process_map(small_map)
+    expected = read_bytes(file_out)
+    assert wrangle.process_map_parallel(small_map, processes=2, chunk_size=1 << 16) == expected.count(b'\n')
+    assert read_bytes(file_out) == expected
+    wrangle.process_map_resumable(small_map, interval=0, chunk_size=1 << 16)
+    assert read_bytes(file_out) == expected
+    deque(wrangle.pipeline_map(small_map, batch_size=100), maxlen=0)
+    assert read_bytes(file_out) == expected
+    wrangle.process_map(small_map, pipeline=True)
+    assert read_bytes(file_out) == expected
+    wrangle.process_map(small_map, compression='gzip')
+    with gzip.open(file_out + '.gz', 'rb') as f:
+        assert f.read() == expected
+
+class Crash(Exception):
+    pass
+
+def test_resume_after_crash(wrangle, small_map, monkeypatch):
+    file_out = small_map + '.json'
+    wrangle.process_map(small_map)
+    expected = read_bytes(file_out)
+    split_map = wrangle.split_map
+
+    def crashing_split_map(*args):
+        ranges = split_map(*args)
+        for i in range(5):
+            yield next(ranges)
+        raise Crash()
+
+    monkeypatch.setattr(wrangle, 'split_map', crashing_split_map)
+    with pytest.raises(Crash):
+        wrangle.process_map_resumable(small_map, interval=0, chunk_size=1 << 16)
+    monkeypatch.undo()
+    assert os.path.exists(wrangle.checkpoint_file(file_out))
+    # half a line written after the last checkpoint
+    with open(file_out, 'ab') as f:
+        f.write(b'{"type": "node", "id": ')
+    assert 0 < os.path.getsize(file_out) < len(expected)
+    assert wrangle.process_map_resumable(small_map, resume=True, chunk_size=1 << 16) == expected.count(b'\n')
+    assert read_bytes(file_out) == expected
+    assert not os.path.exists(wrangle.checkpoint_file(file_out))
+
+
+def test_audits_in_one_pass(wrangle, small_map):
+    results = wrangle.run_audits(small_map)
+    # each audit on its own pass over the file, as they were run before
+    for name, visitor, initial in wrangle.audit_visitors:
+        result = copy.deepcopy(initial)
+        for elem in wrangle.iter_map(small_map):
+            result = visitor(elem, result)
+        assert results[name] == result
+
+
+def uncached(wrangle, monkeypatch, function, *args):
+    with monkeypatch.context() as patch:
+        patch.setitem(wrangle.result_cache, 'enabled', False)
+        patch.setattr(wrangle, 'audit_cache', {})
+        return function(*args)
+
+def test_audit_cache_follows_the_map(wrangle, tmp_path, monkeypatch):
+    path = str(tmp_path / 'audited.osm')
+    for seed in [4, 5]:
+        # the same file name, written again with another map
+        wrangle.generate_map(path, 1 << 18, seed=seed)
+        results = wrangle.run_audits(path)
+        assert results == uncached(wrangle, monkeypatch, wrangle.run_audits, path)
+        assert wrangle.run_audits(path) is results
+        street_types = wrangle.audit(path, wrangle.street_type_re, wrangle.expected_names)
+        assert street_types == uncached(wrangle, monkeypatch, wrangle.audit, path, wrangle.street_type_re,
+                                        wrangle.expected_names)
+        # as in a new session, from the cache on disk
+        wrangle.audit_cache.clear()
+        hits = wrangle.result_cache_stats['hits']
+        assert wrangle.run_audits(path) == results
+        assert wrangle.result_cache_stats['hits'] == hits + 1
+
+def test_clear_cache(wrangle, small_map):
+    wrangle.run_audits(small_map)
+    wrangle.audit(small_map, wrangle.street_type_re, wrangle.expected_names)
+    kinds = lambda: set(os.path.basename(path).split('-')[0] for used, size, path in wrangle.cache_entries())
+    assert {'audits', 'audit'} <= kinds()
+    assert wrangle.clear_cache('audit') > 0
+    assert 'audit' not in kinds() and 'audits' in kinds()
+    wrangle.clear_cache()
+    assert not wrangle.cache_entries() and not wrangle.audit_cache
+
+
+def test_compact_records_are_lossless(wrangle, small_map):
+    docs = list(wrangle.shape_map(small_map))
+    # values that look like numbers, but only some of them read back from one
+    docs[0]['address'] = {'housenumber': '²', 'unit': '①', 'street': '007'}
+    records, table = wrangle.compact_map(small_map)
+    records[0] = wrangle.compact_element(table, docs[0])
+    assert list(wrangle.expand_map(records, table)) == docs
+
+
+def test_split_rules(wrangle):
+    assert wrangle.clean_street('10 Mile Road') == {'street': '10 Mile Road'}
+    assert wrangle.clean_street('250 N 1st St') == {'housenumber': '250', 'street': 'North 1st Street'}
+    assert wrangle.clean_street('Zanker Road, Milpitas, CA') == {'street': 'Zanker Road', 'city': 'Milpitas',
+                                                                 'state': 'CA'}
+
+
+def test_spilled_nodes_are_sorted(wrangle):
+    rng = np.random.RandomState(0)
+    ids = rng.permutation(5000) + 1
+    # some nodes twice, which keep the order they came in
+    ids[::7] = ids[1::7]
+    stores = [wrangle.node_store(), wrangle.node_store(max_memory_nodes=1000, chunk_size=100)]
+    for store in stores:
+        for i, node_id in enumerate(ids):
+            wrangle.add_node(store, node_id, 37 + i * 1e-5, -122 + i * 1e-5)
+        wrangle.finalize_nodes(store)
+    assert stores[1]['files'] is not None
+    for in_memory, spilled in zip(*[store['index'] for store in stores]):
+        assert np.array_equal(in_memory, spilled)
+    assert np.all(np.diff(stores[1]['index'][0]) >= 0)
+
+
+def test_backends_agree(wrangle, small_map, monkeypatch):
+    records = list(wrangle.iter_records(small_map, 'expat'))
+    docs = list(wrangle.shape_map(small_map, relations=True))
+    # lxml is left out when it is not installed
+    backends = [name for name in wrangle.xml_backends if name != 'lxml' or wrangle.lxml is not None]
+    for backend in backends:
+        assert list(wrangle.iter_records(small_map, backend)) == records
+        monkeypatch.setattr(wrangle, 'xml_backend', backend)
+        assert list(wrangle.shape_map(small_map, relations=True)) == docs
+
+
+def test_load_map(wrangle, small_map, collection):
+    docs = list(wrangle.shape_map(small_map, geometry=True))
+    assert wrangle.load_map(small_map, collection, geometry=True)['documents'] == len(docs)
+    assert collection.count_documents({}) == len(docs)
+    node = collection.find_one({'type': 'node', 'id': docs[0]['id']})
+    assert node['location'] == {'type': 'Point', 'coordinates': [node['pos'][1], node['pos'][0]]}
+    way = collection.find_one({'type': 'way'})
+    assert way['location'] == {'type': 'Point', 'coordinates': [way['centroid'][1], way['centroid'][0]]}
+
+
+change_file = '''<?xml version="1.0" encoding="UTF-8"?>
+<osmChange version="0.6" generator="test">
+ <modify>
+  <node id="1" version="9" changeset="60000000" timestamp="2016-01-01T00:00:00Z" user="user1" uid="1"
+        lat="37.3300000" lon="-121.8900000">
+   <tag k="amenity" v="cafe"/>
+   <tag k="addr:postcode" v="95112"/>
+   <tag k="addr:city" v="San Jose"/>
+  </node>
+ </modify>
+ <delete>
+  <node id="2" version="9" changeset="60000000" timestamp="2016-01-01T00:00:00Z" user="user1" uid="1"
+        lat="37.3300000" lon="-121.8900000"/>
+ </delete>
+ <create>
+  <node id="9999999" version="1" changeset="60000001" timestamp="2016-01-02T00:00:00Z" user="newcomer"
+        uid="99999" lat="37.3400000" lon="-121.8800000">
+   <tag k="leisure" v="park"/>
+  </node>
+ </create>
+</osmChange>
+'''
+
+def same_report(report, expected):
+    # the values with the same count can come in any order
+    order = lambda value: sorted(value, key=repr) if isinstance(value, list) else value
+    return dict((name, order(value)) for name, value in report.items()) == \
+        dict((name, order(value)) for name, value in expected.items())
+
+def test_apply_changes(wrangle, small_map, collection, tmp_path):
+    wrangle.load_map(small_map, collection)
+    stats = wrangle.new_report_stats(max_exact=1 << 30)
+    for el in collection.find({}, {'_id': 0}):
+        wrangle.count_document(stats, el)
+    change = str(tmp_path / 'change.osc')
+    with open(change, 'w') as f:
+        f.write(change_file)
+    summary = wrangle.apply_changes(change, collection, stats)
+    assert summary == {'modify node': 1, 'delete node': 1, 'create node': 1}
+    assert collection.find_one({'type': 'node', 'id': '1'})['amenity'] == 'cafe'
+    assert collection.find_one({'type': 'node', 'id': '2'}) is None
+    assert collection.find_one({'type': 'node', 'id': '9999999'})['created']['user'] == 'newcomer'
+    recounted = wrangle.new_report_stats(max_exact=1 << 30)
+    for el in collection.find({}, {'_id': 0}):
+        wrangle.count_document(recounted, el)
+    assert same_report(wrangle.report_stats(stats), wrangle.report_stats(recounted))
+
+
+def test_column_docs(wrangle, small_map, tmp_path):
+    path = str(tmp_path / 'small.columns')
+    wrangle.write_columns(wrangle.shape_map(small_map), path, chunk_size=1000)
+    assert list(wrangle.column_docs(wrangle.open_columns(path))) == list(wrangle.shape_map(small_map))
+
+
+def test_report_statistics(wrangle, small_map, tmp_path):
+    path = str(tmp_path / 'report.columns')
+    wrangle.write_columns(wrangle.shape_map(small_map), path, chunk_size=1000)
+    assert wrangle.column_report(wrangle.open_columns(path)) == wrangle.analyze_map(small_map)
+
+
+multipolygon_map = '''<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6" generator="test">
+ <node id="1" lat="37.0000000" lon="-122.0000000"/>
+ <node id="2" lat="37.0000000" lon="-121.9000000"/>
+ <node id="3" lat="37.1000000" lon="-121.9000000"/>
+ <node id="4" lat="37.1000000" lon="-122.0000000"/>
+ <way id="10"><nd ref="1"/><nd ref="2"/><nd ref="3"/></way>
+ <way id="11"><nd ref="1"/><nd ref="4"/><nd ref="3"/></way>
+ <relation id="20">
+  <member type="way" ref="10" role="outer"/>
+  <member type="way" ref="11" role="outer"/>
+  <tag k="type" v="multipolygon"/>
+ </relation>
+ <relation id="21">
+  <member type="way" ref="10" role="outer"/>
+  <member type="way" ref="12" role="outer"/>
+  <tag k="type" v="multipolygon"/>
+ </relation>
+</osm>
+'''
+
+moved_node = '''<?xml version="1.0" encoding="UTF-8"?>
+<osmChange version="0.6" generator="test">
+ <modify>
+  <node id="4" lat="37.2000000" lon="-122.0000000"/>
+ </modify>
+</osmChange>
+'''
+
+def test_assemble_rings(wrangle):
+    # the second way runs the other way round
+    assert wrangle.assemble_rings([[1, 2, 3], [1, 4, 3]]) == ([[1, 2, 3, 4, 1]], [])
+    assert wrangle.assemble_rings([[1, 2, 3], [3, 5]]) == ([], [[1, 2, 3, 5]])
+
+def test_relation_rings(wrangle, tmp_path, collection):
+    path = str(tmp_path / 'multipolygon.osm')
+    with open(path, 'w') as f:
+        f.write(multipolygon_map)
+    relations = dict((el['id'], el) for el in wrangle.shape_map(path, geometry=True, relations=True)
+                     if el['type'] == 'relation')
+    ring = relations['20']
+    assert ring['outer'] == [[[37.0, -122.0], [37.0, -121.9], [37.1, -121.9], [37.1, -122.0], [37.0, -122.0]]]
+    assert ring['inner'] == []
+    assert ring['centroid'] == pytest.approx([37.05, -121.95])
+    assert ring['bbox'] == [37.0, -122.0, 37.1, -121.9]
+    assert 'incomplete' not in ring
+    # way 12 is not in the map
+    assert relations['21']['incomplete'] and relations['21']['outer'] == []
+
+    wrangle.load_map(path, collection, geometry=True, relations=True)
+    change = str(tmp_path / 'moved.osc')
+    with open(change, 'w') as f:
+        f.write(moved_node)
+    summary = wrangle.apply_changes(change, collection, geometry=True, relations=True)
+    assert summary['relation rings'] == 1
+    ring = collection.find_one({'type': 'relation', 'id': '20'})
+    assert ring['outer'][0][3] == [37.2, -122.0]
+    assert ring['bbox'] == [37.0, -122.0, 37.2, -121.9]
+
+
+def test_region_relations(wrangle):
+    records = [('node', {'id': '1', 'lat': '37.0', 'lon': '-122.0'}, [], [], []),
+               ('node', {'id': '2', 'lat': '38.0', 'lon': '-122.0'}, [], [], []),
+               # 20 and 21 only have relations that come after them, and 23 nothing in the region
+               ('relation', {'id': '20'}, [], [], [('relation', '21', '')]),
+               ('relation', {'id': '21'}, [], [], [('node', '2', ''), ('relation', '22', '')]),
+               ('relation', {'id': '22'}, [], [], [('node', '1', '')]),
+               ('relation', {'id': '23'}, [], [], [('relation', '24', '')]),
+               ('relation', {'id': '24'}, [], [], [('node', '2', '')])]
+    kept = [record[1]['id'] for record in wrangle.region_records(records, [36.9, -122.1, 37.1, -121.9])]
+    assert kept == ['1', '22', '21', '20']
+
+
+def test_load_region(wrangle, small_map, collection):
+    region = [37.30, -121.95, 37.36, -121.85]
+    docs = list(wrangle.shape_map(small_map, region=region))
+    assert 0 < len(docs) < len(list(wrangle.shape_map(small_map)))
+    assert wrangle.load_map(small_map, collection, region=region)['documents'] == len(docs)
+    assert collection.count_documents({}) == len(docs)
+
+
+# A PBF writer for the tests, from the format description at https://wiki.openstreetmap.org/wiki/PBF_Format,
+# so the decoder is checked against the spec rather than against itself.
+
+def varint(n):
+    n &= (1 << 64) - 1
+    out = bytearray()
+    while True:
+        if n < 0x80:
+            out.append(n)
+            return bytes(out)
+        out.append(n & 0x7f | 0x80)
+        n >>= 7
+
+def zigzag(n):
+    return (n << 1) ^ (n >> 63)
+
+def field(number, value):
+    if isinstance(value, bytes):
+        return varint(number << 3 | 2) + varint(len(value)) + value
+    return varint(number << 3) + varint(value)
+
+def packed(number, values, signed = False):
+    return field(number, b''.join(varint(zigzag(v) if signed else v) for v in values))
+
+def delta(values):
+    return [b - a for a, b in zip([0] + values[:-1], values)]
+
+def fixed(value):
+    # degrees in units of the default granularity, 100 nanodegrees
+    return int(Decimal(value) * 10 ** 7)
+
+def seconds(timestamp):
+    return int(calendar.timegm(time.strptime(timestamp, "%Y-%m-%dT%H:%M:%SZ")))
+
+def write_blob(f, blob_type, data):
+    blob = field(2, len(data)) + field(3, zlib.compress(data))
+    header = field(1, blob_type.encode('ascii')) + field(3, len(blob))
+    f.write(struct.pack('>i', len(header)) + header + blob)
+
+class StringTable(object):
+    def __init__(self):
+        # string 0 is the empty string, so it can end the tags of a dense node
+        self.strings = {'': 0}
+
+    def __call__(self, s):
+        return self.strings.setdefault(s, len(self.strings))
+
+    def encode(self):
+        ordered = sorted(self.strings, key=self.strings.get)
+        return b''.join(field(1, s.encode('utf-8')) for s in ordered)
+
+def info(attrib, strings):
+    return (field(1, int(attrib['version'])) + field(2, seconds(attrib['timestamp'])) +
+            field(3, int(attrib['changeset'])) + field(4, int(attrib['uid'])) +
+            field(5, strings(attrib['user'])) + field(6, attrib['visible'] == 'true'))
+
+def dense_nodes(records, strings):
+    ids = [int(r[1]['id']) for r in records]
+    keys_vals = []
+    for r in records:
+        for k, v in r[2]:
+            keys_vals += [strings(k), strings(v)]
+        keys_vals.append(0)
+    dense_info = (packed(1, [int(r[1]['version']) for r in records]) +
+                  packed(2, delta([seconds(r[1]['timestamp']) for r in records]), True) +
+                  packed(3, delta([int(r[1]['changeset']) for r in records]), True) +
+                  packed(4, delta([int(r[1]['uid']) for r in records]), True) +
+                  packed(5, delta([strings(r[1]['user']) for r in records]), True) +
+                  packed(6, [r[1]['visible'] == 'true' for r in records]))
+    return (packed(1, delta(ids), True) + field(5, dense_info) +
+            packed(8, delta([fixed(r[1]['lat']) for r in records]), True) +
+            packed(9, delta([fixed(r[1]['lon']) for r in records]), True) + packed(10, keys_vals))
+
+def way_or_relation(record, strings):
+    tag, attrib, tags, refs, members = record
+    data = (field(1, int(attrib['id'])) + packed(2, [strings(k) for k, v in tags]) +
+            packed(3, [strings(v) for k, v in tags]) + field(4, info(attrib, strings)))
+    if tag == 'way':
+        return data + packed(8, delta([int(ref) for ref in refs]), True)
+    return (data + packed(8, [strings(role) for t, ref, role in members]) +
+            packed(9, delta([int(ref) for t, ref, role in members]), True) +
+            packed(10, [['node', 'way', 'relation'].index(t) for t, ref, role in members]))
+
+def write_pbf(records, path, block_size = 500):
+    with open(path, 'wb') as f:
+        write_blob(f, 'OSMHeader', field(4, b'OsmSchema-V0.6') + field(4, b'DenseNodes'))
+        for start in range(0, len(records), block_size):
+            block = records[start:start + block_size]
+            strings = StringTable()
+            groups = b''
+            # one group for each kind of element, in file order
+            for tag in ['node', 'way', 'relation']:
+                group = [r for r in block if r[0] == tag]
+                if tag == 'node' and group:
+                    groups += field(2, field(2, dense_nodes(group, strings)))
+                elif group:
+                    number = 3 if tag == 'way' else 4
+                    groups += field(2, b''.join(field(number, way_or_relation(r, strings)) for r in group))
+            write_blob(f, 'OSMData', field(1, strings.encode()) + groups)
+
+def test_pbf_matches_xml(wrangle, small_map, tmp_path):
+    records = [r for r in wrangle.iter_records(small_map) if r[0] in ('node', 'way', 'relation')]
+    pbf = str(tmp_path / 'small.osm.pbf')
+    write_pbf(records, pbf)
+    assert list(wrangle.iter_pbf_records(pbf, processes=2)) == records
+    assert list(wrangle.shape_map(pbf, relations=True)) == list(wrangle.shape_map(small_map, relations=True))